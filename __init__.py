@@ -9,13 +9,20 @@ __all__ = ['register']
 def register():
     # Prevent import of backend when importing scripts
     from . import census
+    from . import company
     from . import tax
 
     Pool.register(
         census.ClassCode,
+        census.PlaceCounty,
         census.Place,
         census.Region,
+        census.Boundary,
+        tax.TaxGroup,
         tax.Tax,
+        tax.SSTPVersion,
+        tax.SSTPRate,
+        company.Company,
         module='account_us_sstp', type_='model')
     Pool.register(
         module='account_us_sstp', type_='wizard')
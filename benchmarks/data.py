@@ -0,0 +1,123 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Generate synthetic census and SSTP rate files
+
+The files are written under a directory laid out by host and path like the
+original URLs so they can be served by the stand-in server."""
+import io
+import os
+import random
+import string
+import zipfile
+from collections import namedtuple
+
+CENSUS_PATH = 'www2.census.gov/geo/docs/reference/codes2020'
+RATES_PATH = 'www.streamlinedsalestax.org/ratesandboundry/Rates'
+RATES_NAME = '%sR2026Q4OCT01'
+DATES = [('20080101', '20191231'), ('20200101', '20241231')]
+END_DATE = '29991231'
+SYLLABLES = [
+    'al', 'an', 'ba', 'ber', 'bro', 'ca', 'cen', 'da', 'del', 'el', 'fair',
+    'field', 'ford', 'glen', 'ham', 'har', 'hill', 'land', 'lake', 'ley',
+    'mar', 'mont', 'new', 'or', 'port', 'ri', 'ro', 'san', 'son', 'spring',
+    'ston', 'ta', 'ton', 'val', 'ville', 'wood']
+
+State = namedtuple('State', ['code', 'code_fips', 'name'])
+
+
+def _name(rng):
+    return ''.join(
+        rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3))).title()
+
+
+def get_states(states):
+    "Return the synthetic states"
+    codes = (a + b for a in string.ascii_uppercase
+        for b in string.ascii_uppercase)
+    return [State(next(codes), '%02d' % i, "State %02d" % i)
+        for i in range(1, states + 1)]
+
+
+def write_census(directory, states, counties=60, places=13, seed=0):
+    "Write the national state, county and place by county files"
+    rng = random.Random(seed)
+    path = os.path.join(directory, CENSUS_PATH)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'national_state2020.txt'), 'w') as f:
+        f.write('STATE|STATEFP|STATENS|STATE_NAME\n')
+        for i, state in enumerate(states, 1):
+            f.write('%s|%s|%08d|%s\n' % (
+                    state.code, state.code_fips, i, state.name))
+    with open(os.path.join(path, 'national_county2020.txt'), 'w') as cf, \
+            open(os.path.join(path, 'national_place_by_county2020.txt'),
+                'w') as pf:
+        cf.write('STATE|STATEFP|COUNTYFP|COUNTYNS|COUNTYNAME|CLASSFP|'
+            'FUNCSTAT\n')
+        pf.write('STATE|STATEFP|COUNTYFP|COUNTYNAME|PLACEFP|PLACENS|'
+            'PLACENAME|TYPE|CLASSFP|FUNCSTAT\n')
+        gnis = 1000
+        for state in states:
+            for county_fips, place_fips in _jurisdictions(counties, places):
+                gnis += 1
+                county = "%s County" % _name(rng)
+                cf.write('%s|%s|%s|%08d|%s|H1|A\n' % (
+                        state.code, state.code_fips, county_fips, gnis,
+                        county))
+                for code in place_fips:
+                    gnis += 1
+                    pf.write('%s|%s|%s|%s|%s|%08d|%s city|INCORPORATED PLACE|'
+                        'C1|A\n' % (
+                            state.code, state.code_fips, county_fips, county,
+                            code, gnis, _name(rng)))
+
+
+def write_rates(directory, states, counties=60, places=13, changed=0,
+        seed=0):
+    """Write the rates archive of each state and the page linking them
+
+    A fraction changed of the jurisdictions get a new rate version."""
+    rng = random.Random(seed)
+    path = os.path.join(directory, RATES_PATH)
+    os.makedirs(path, exist_ok=True)
+    links = []
+    for state in states:
+        data = io.StringIO()
+        _write_versions(
+            data, rng, changed, state.code_fips, '45', state.code_fips)
+        for county_fips, place_fips in _jurisdictions(counties, places):
+            _write_versions(
+                data, rng, changed, state.code_fips, '00', county_fips)
+            for code in place_fips:
+                _write_versions(
+                    data, rng, changed, state.code_fips, '01', code)
+        name = RATES_NAME % state.code
+        with zipfile.ZipFile(os.path.join(path, name + '.zip'), 'w',
+                zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(name + '.csv', data.getvalue())
+        links.append('/ratesandboundry/Rates/%s.zip' % name)
+    with open(os.path.join(path, 'index.html'), 'w') as f:
+        f.write('<html><body>%s</body></html>' % ''.join(
+                '<a href="%s">%s</a>' % (l, os.path.basename(l))
+                for l in links))
+
+
+def _jurisdictions(counties, places):
+    "Yield the FIPS code of each county with the codes of its places"
+    for c in range(counties):
+        yield '%03d' % (2 * c + 1), [
+            '%05d' % (10 * (c * places + p) + 10) for p in range(places)]
+
+
+def _write_versions(f, rng, changed, state_fips, type_, code_fips):
+    base = rng.randint(0, 300) / 10000
+    dates = list(DATES)
+    if rng.random() < changed:
+        dates.append(('20250101', END_DATE))
+    else:
+        dates[-1] = (dates[-1][0], END_DATE)
+    for i, (start_date, end_date) in enumerate(dates):
+        general = base + i * 0.0025
+        food = base / 2
+        f.write('%s,%s,%s,%.4f,%.4f,%.4f,%.4f,%s,%s\n' % (
+                state_fips, type_, code_fips, general, general, food, food,
+                start_date, end_date))
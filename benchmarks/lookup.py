@@ -0,0 +1,203 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Measure the latency of the SSTP lookups on a national scale dataset
+
+Run it like the tests, for example:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.account_us_sstp.benchmarks.lookup
+"""
+import datetime as dt
+import json
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, activate_module
+from trytond.transaction import Transaction
+
+BATCH_SIZE = 1000
+DATES = [dt.date(2008, 1, 1), dt.date(2020, 1, 1)]
+
+
+def _batches(vlist, size=BATCH_SIZE):
+    for i in range(0, len(vlist), size):
+        yield vlist[i:i + size]
+
+
+def populate(states=50, counties=60, places=13, taxes=True):
+    "Create the places and taxes and return the keys to look up"
+    pool = Pool()
+    Country = pool.get('country.country')
+    Subdivision = pool.get('country.subdivision')
+    Place = pool.get('census.place')
+    Tax = pool.get('account.tax')
+    TaxGroup = pool.get('account.tax.group')
+    Account = pool.get('account.account')
+    AccountType = pool.get('account.account.type')
+
+    from trytond.modules.company.tests import create_company, set_company
+    company = create_company()
+    with set_company(company):
+        account_type, = AccountType.create([{
+                    'name': "Tax", 'statement': 'balance',
+                    'company': company.id,
+                    }])
+        account, = Account.create([{
+                    'name': "Main Tax", 'type': account_type.id,
+                    'company': company.id,
+                    }])
+        group = TaxGroup.sstp_code2id()['00']
+
+        country, = Country.create([{'name': "United States", 'code': 'US'}])
+        subdivisions = Subdivision.create([{
+                    'name': "State %02d" % i,
+                    'code': 'US-%02d' % i,
+                    'type': 'state',
+                    'country': country.id,
+                    } for i in range(1, states + 1)])
+        state_places = Place.create([{
+                    'name': s.name,
+                    'code_fips': '%02d' % i,
+                    'code_gnis': i,
+                    'country': country.id,
+                    'subdivision': s.id,
+                    } for i, s in enumerate(subdivisions, 1)])
+        county_values = [{
+                'name': "County %s" % c,
+                'code_fips': '%03d' % c,
+                'code_gnis': 1000 * s.id + c,
+                'country': country.id,
+                'subdivision': s.subdivision.id,
+                'parent': s.id,
+                } for s in state_places for c in range(1, counties + 1)]
+        county_places = []
+        for vlist in _batches(county_values):
+            county_places.extend(Place.create(vlist))
+        place_values = [{
+                'name': "Place %s" % p,
+                'code_fips': '%05d' % (c.id * places + p),
+                'code_gnis': 10 ** 6 + c.id * places + p,
+                'country': country.id,
+                'subdivision': c.subdivision.id,
+                'parent': c.id,
+                } for c in county_places for p in range(places)]
+        keys = []
+        for vlist in _batches(place_values):
+            keys.extend(
+                (p.subdivision.id, p.subdivision.code, p.code_fips,
+                    p.code_gnis, p.parent.parent.id, p.id)
+                for p in Place.create(vlist))
+
+        if taxes:
+            authorities = {s.subdivision.id: s.id for s in state_places}
+            for batch in _batches(keys, BATCH_SIZE // (len(DATES) + 1)):
+                parents = Tax.create([{
+                            'company': company.id,
+                            'name': '%s general_rate_intrastate' % k[2],
+                            'description': k[2],
+                            'type': 'none',
+                            'group': group,
+                            'authority': authorities[k[0]],
+                            'jurisdiction': k[5],
+                            } for k in batch])
+                Tax.create([{
+                            'company': company.id,
+                            'name': p.name,
+                            'description': p.description,
+                            'type': 'percentage',
+                            'rate': Decimal('0.01'),
+                            'group': group,
+                            'authority': p.authority.id,
+                            'jurisdiction': p.jurisdiction.id,
+                            'parent': p.id,
+                            'start_date': date,
+                            'invoice_account': account.id,
+                            'credit_note_account': account.id,
+                            } for p in parents for date in DATES])
+        return keys
+
+
+def _stats(durations):
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'mean_ms': 1000 * sum(durations) / len(durations),
+        'p50_ms': 1000 * durations[len(durations) // 2],
+        'p95_ms': 1000 * durations[int(len(durations) * 0.95)],
+        }
+
+
+def _time(func, keys):
+    durations = []
+    for key in keys:
+        start = time.perf_counter()
+        func(key)
+        durations.append(time.perf_counter() - start)
+    return _stats(durations)
+
+
+def measure(keys, lookups=1000, taxes=True):
+    "Return the latency statistics of each lookup"
+    pool = Pool()
+    Place = pool.get('census.place')
+    Tax = pool.get('account.tax')
+
+    sample = random.sample(keys, min(lookups, len(keys)))
+    result = {
+        'place_by_code_fips': _time(lambda k: Place.search([
+                    ('subdivision', '=', k[0]),
+                    ('code_fips', '=', k[2]),
+                    ]), sample),
+        'place_by_code_gnis': _time(lambda k: Place.search([
+                    ('code_gnis', '=', k[3]),
+                    ]), sample),
+        }
+    if taxes:
+        result['tax_by_authority'] = _time(lambda k: Tax.search([
+                    ('authority', '!=', None),
+                    ('authority.subdivision.code', '=', k[1]),
+                    ('name', '=', '%s general_rate_intrastate' % k[2]),
+                    ('start_date', '=', DATES[-1]),
+                    ]), sample)
+        result['tax_by_jurisdiction'] = _time(lambda k: Tax.search([
+                    ('jurisdiction', '=', k[5]),
+                    ('start_date', '<=', dt.date.today()),
+                    ], order=[('start_date', 'DESC')], limit=1), sample)
+    return result
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--states', type=int, default=50)
+    parser.add_argument('--counties', type=int, default=60,
+        help='the number of counties per state')
+    parser.add_argument('--places', type=int, default=13,
+        help='the number of places per county')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--no-taxes', dest='taxes', action='store_false')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    activate_module('account_us_sstp')
+    with Transaction().start(DB_NAME, 0, context={}) as transaction:
+        start = time.perf_counter()
+        keys = populate(args.states, args.counties, args.places, args.taxes)
+        populate_time = time.perf_counter() - start
+        result = {
+            'database': transaction.database.name,
+            'places': len(keys),
+            'populate_s': populate_time,
+            'lookups': measure(keys, args.lookups, args.taxes),
+            }
+        transaction.rollback()
+    json.dump(result, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,30 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"Serve a directory over HTTP in place of the census and SSTP sites"
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def serve(directory):
+    """Yield the base URL of a local server of directory
+
+    It is meant to be used as the mirror of the import scripts."""
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), partial(QuietHandler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://%s:%s/' % server.server_address[:2]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,176 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Time the imports and the queries on synthetic census and SSTP data
+
+The files are generated in a temporary directory and served by a local
+server used as the mirror of the import scripts. Run it like the tests on
+SQLite or PostgreSQL, for example:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+        python -m trytond.modules.account_us_sstp.benchmarks.suite
+"""
+import datetime as dt
+import json
+import random
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from proteus import Model
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME
+from trytond.tests.tools import activate_modules
+from trytond.transaction import Transaction
+
+from ..scripts import import_places, import_rates
+from ..scripts.loader import LOADERS
+from .data import get_states, write_census, write_rates
+from .lookup import _stats, _time
+from .server import serve
+
+
+def setup(states):
+    "Activate the module and create the records the import scripts need"
+    from trytond.modules.company.tests.tools import create_company
+
+    activate_modules('account_us_sstp')
+    Country = Model.get('country.country')
+    Subdivision = Model.get('country.subdivision')
+    Company = Model.get('company.company')
+    AccountType = Model.get('account.account.type')
+    Account = Model.get('account.account')
+
+    country = Country(name="United States", code='US')
+    country.save()
+    Subdivision.save([Subdivision(
+                name=s.name, code='US-%s' % s.code, type='state',
+                country=country) for s in states])
+    create_company()
+    company, = Company.find()
+    account_type = AccountType(
+        name="Tax", statement='balance', company=company)
+    account_type.save()
+    Account(name="Main Tax", type=account_type, company=company).save()
+    return company.id
+
+
+def _timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def measure_imports(directory, mirror, states, counties, places, changed,
+        seed, loader, jobs):
+    "Return the duration of the full and incremental imports"
+    codes = [s.code for s in states]
+    options = {'mirror': mirror, 'loader': loader}
+    result = {
+        'places_s': _timed(import_places.main, DB_NAME, codes, **options),
+        'rates_full_s': _timed(
+            import_rates.main, DB_NAME, codes, jobs=jobs, **options),
+        }
+    write_rates(directory, states, counties, places, changed=changed,
+        seed=seed)
+    result['rates_incremental_s'] = _timed(
+        import_rates.main, DB_NAME, codes, jobs=jobs, **options)
+    return result
+
+
+def measure_queries(company, lookups=1000, date=None):
+    "Return the latency statistics of the autocomplete and tree queries"
+    pool = Pool()
+    Place = pool.get('census.place')
+    Tax = pool.get('account.tax')
+    Rate = pool.get('account.tax.sstp.rate')
+
+    if date is None:
+        date = dt.date.today()
+    places = Place.search_read([
+            ('level', '=', 'place'),
+            ], fields_names=['name', 'code_fips', 'parent'])
+    sample = random.sample(places, min(lookups, len(places)))
+    with Transaction().set_context(company=company):
+        result = {
+            'autocomplete_name': _time(
+                lambda p: Place.autocomplete(p['name'][:4], limit=10),
+                sample),
+            'autocomplete_code_fips': _time(
+                lambda p: Place.autocomplete(p['code_fips'][:3], limit=10),
+                sample),
+            'subtree_children': _time(
+                lambda p: Place.search(
+                    [('parent', 'child_of', [p['parent']])]),
+                sample),
+            'subtree_ancestors': _time(
+                lambda p: Place.search([('parent', 'parent_of', [p['id']])]),
+                sample),
+            'combined_rate': _time(
+                lambda p: Rate.get_rate(
+                    p['id'], date, 'general_rate_intrastate'),
+                sample),
+            'batch_rates': _stats([_timed(
+                        Tax.sstp_rates,
+                        [(p['id'], date, 'general_rate_intrastate')
+                            for p in sample])]),
+            }
+    return result
+
+
+def run():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--states', type=int, default=3)
+    parser.add_argument('--counties', type=int, default=20,
+        help='the number of counties per state')
+    parser.add_argument('--places', type=int, default=10,
+        help='the number of places per county')
+    parser.add_argument('--changed', type=float, default=0.05,
+        help='the fraction of jurisdictions with a new rate version '
+        'for the incremental import')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('-l', '--loader', choices=LOADERS, default='trytond')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output',
+        help='the file to write the JSON results to instead of stdout')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    states = get_states(args.states)
+    with tempfile.TemporaryDirectory() as directory:
+        write_census(
+            directory, states, args.counties, args.places, seed=args.seed)
+        write_rates(
+            directory, states, args.counties, args.places, seed=args.seed)
+        company = setup(states)
+        with serve(directory) as mirror:
+            imports = measure_imports(
+                directory, mirror, states, args.counties, args.places,
+                args.changed, args.seed, args.loader, args.jobs)
+
+    with Transaction().start(DB_NAME, 0, context={}) as transaction:
+        result = {
+            'backend': transaction.database.__module__.split('.')[-2],
+            'database': transaction.database.name,
+            'scale': {
+                'states': args.states,
+                'counties': args.counties,
+                'places': args.places,
+                'changed': args.changed,
+                'loader': args.loader,
+                'jobs': args.jobs,
+                },
+            'imports': imports,
+            'queries': measure_queries(company, args.lookups),
+            }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,15 +1,88 @@
-from trytond.model import DeactivableMixin, ModelSQL, ModelView, fields, tree
+import datetime as dt
+from array import array
+from bisect import bisect_right
+from itertools import count
+
+from sql import Literal, Null
+from sql.aggregate import Count
+from sql.conditionals import Case
+from sql.functions import CharLength
+
+from trytond.cache import Cache
+from trytond.model import (
+    DeactivableMixin, Index, ModelSQL, ModelView, Unique, fields, tree)
+from trytond.pool import Pool
 from trytond.pyson import Eval
-from trytond.tools import is_full_text, lstrip_wildcard
+from trytond.rpc import RPC
+from trytond.tools import (
+    grouped_slice, is_full_text, lstrip_wildcard, reduce_ids,
+    unescape_wildcard)
+from trytond.transaction import Transaction
+
+
+class CodeMixin:
+    "Cache the id of the records by code"
+    __slots__ = ()
+    _code2id_cache = None
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'code2id': RPC(),
+                })
+
+    @classmethod
+    def code2id(cls):
+        "Return a dictionary mapping the codes to the ids"
+        code2id = cls._code2id_cache.get(None)
+        if code2id is None:
+            with Transaction().set_context(active_test=False):
+                code2id = {r.code: r.id for r in cls.search(
+                        [('code', '!=', None)], order=[('id', 'ASC')])}
+            cls._code2id_cache.set(None, code2id)
+        return code2id
+
+    @classmethod
+    def get_by_code(cls, code):
+        "Return the record with the code or None"
+        id_ = cls.code2id().get(code)
+        if id_ is not None:
+            return cls(id_)
 
-class Region(tree(), ModelSQL, ModelView):
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        cls._code2id_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._code2id_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        cls._code2id_cache.clear()
+
+LEVELS = {
+    2: 'state',
+    3: 'county',
+    5: 'place',
+    }
+
+
+class Region(CodeMixin, tree(), ModelSQL, ModelView):
     "Region"
     __name__ = 'census.region'
+    _code2id_cache = Cache(__name__ + '.code2id', context=False)
 
     name = fields.Char("Name", required=True, translate=True)
     code = fields.Char("Code", size=2,
             help="Region or division code of the census.")
-    parent = fields.Many2One('census.region', "Parent")
+    parent = fields.Many2One('census.region', "Parent", path='path')
+    path = fields.Char("Path", readonly=True)
     divisions = fields.One2Many('census.region', 'parent', "Divisions")
     places = fields.One2Many(
             'census.place', 'region', "Places",
@@ -22,6 +95,9 @@ class Region(tree(), ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.path, Index.Similarity(begin=True))))
         cls._order.insert(0, ('code', 'ASC'))
 
     @classmethod
@@ -38,9 +114,10 @@ class Region(tree(), ModelSQL, ModelView):
             ('code', clause[1], code_value) + tuple(clause[3:]),
             ]
 
-class ClassCode(DeactivableMixin, ModelSQL, ModelView):
+class ClassCode(CodeMixin, DeactivableMixin, ModelSQL, ModelView):
     "Class Code"
     __name__ = 'census.class_code'
+    _code2id_cache = Cache(__name__ + '.code2id', context=False)
     code = fields.Char("Code", size=2, required=True)
     description = fields.Char("Description", required=True)
 
@@ -68,35 +145,172 @@ class Place(tree(), DeactivableMixin, ModelSQL, ModelView):
     code_fips = fields.Char("FIPS Code",
             help="The FIPS code (deprecated) of the geographical location.")
     class_code = fields.Many2One('census.class_code', "Class Code")
-    level = fields.Function(fields.Char("Level"), 'on_change_with_level')
+    level = fields.Selection([
+            ('state', "State"),
+            ('county', "County"),
+            ('place', "Place"),
+            ('unknown', "Unknown"),
+            ], "Level", readonly=True,
+        help="The level of the place computed from the FIPS code.")
     region = fields.Many2One('census.region', "Region")
-    parent = fields.Many2One('census.place', 'Parent',
+    parent = fields.Many2One('census.place', 'Parent', path='path',
             domain=[
                 ('country', '=', Eval('country', -1)),
                 ('subdivision', '=', Eval('subdivision', -1)),
                 ],
             help="Add geographical place below the parent.")
+    path = fields.Char("Path", readonly=True)
     children = fields.One2Many('census.place', 'parent', "Places")
+    counties = fields.Many2Many(
+            'census.place-census.place', 'place', 'county', "Other Counties",
+            domain=[
+                ('level', '=', 'county'),
+                ('subdivision', '=', Eval('subdivision', -1)),
+                ],
+            help="The other counties that the place spans.")
 
 
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('code_fips_uniq', Unique(t, t.subdivision, t.code_fips),
+                'account_us_sstp.msg_place_code_fips_unique'),
+            ]
+        cls._sql_indexes.update({
+                Index(t, (t.path, Index.Similarity(begin=True))),
+                Index(
+                    t,
+                    (t.subdivision, Index.Equality()),
+                    (t.level, Index.Equality())),
+                Index(
+                    t,
+                    (t.subdivision, Index.Equality()),
+                    (t.code_fips, Index.Equality())),
+                Index(t, (t.code_gnis, Index.Equality())),
+                Index(t, (t.code_fips, Index.Similarity(begin=True))),
+                })
         cls._order.insert(0, ('subdivision', 'ASC'))
         cls._order.insert(1, ('code_fips', 'ASC'))
 
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table_h = cls.__table_handler__(module_name)
+        level_exist = table_h.column_exist('level')
+        path_exist = table_h.column_exist('path')
+
+        # Migration from 7.2: merge the places created once per county
+        merged = (table_h.column_exist('code_fips')
+            and cls._merge_duplicates())
+
+        super().__register__(module_name)
+
+        if merged and path_exist:
+            cls._rebuild_path('parent')
+
+        # Migration from 7.2: store level
+        if not level_exist:
+            length = CharLength(table.code_fips)
+            cursor.execute(*table.update(
+                    [table.level],
+                    [Case(*((length == l, v) for l, v in LEVELS.items()),
+                            else_='unknown')]))
+
+    @classmethod
+    def _merge_duplicates(cls):
+        """Merge the places with the same subdivision and FIPS code into the
+        one with the lowest id
+
+        The taxes and the children of the others are moved to the kept place
+        before they are deleted and their parents are kept as its other
+        counties. It returns whether places were merged."""
+        pool = Pool()
+        PlaceCounty = pool.get('census.place-census.place')
+        Tax = pool.get('account.tax')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        duplicate = cls.__table__()
+        tax = Tax.__table__()
+        place_county = PlaceCounty.__table__()
+
+        query = duplicate.select(duplicate.subdivision, duplicate.code_fips,
+            where=duplicate.code_fips != Null,
+            group_by=[duplicate.subdivision, duplicate.code_fips],
+            having=Count(Literal('*')) > 1)
+        query = table.join(query,
+            condition=(table.subdivision == query.subdivision)
+            & (table.code_fips == query.code_fips)
+            ).select(table.id, table.subdivision, table.code_fips,
+                table.parent,
+                order_by=[table.id.asc])
+        cursor.execute(*query)
+        kept, merged, counties = {}, {}, set()
+        for id_, subdivision, code_fips, parent in cursor:
+            key = (subdivision, code_fips)
+            if key in kept:
+                kept_id, kept_parent = kept[key]
+                merged[id_] = kept_id
+                if parent is not None and parent != kept_parent:
+                    counties.add((kept_id, parent))
+            else:
+                kept[key] = (id_, parent)
+        if not merged:
+            return False
+
+        if counties:
+            cursor.execute(*place_county.insert(
+                    [place_county.place, place_county.county],
+                    sorted(counties)))
+
+        columns = [
+            (tax, tax.authority),
+            (tax, tax.jurisdiction),
+            (table, table.parent),
+            ]
+        for sub_ids in grouped_slice(list(merged)):
+            sub_ids = list(sub_ids)
+            for sql_table, column in columns:
+                cursor.execute(*sql_table.update(
+                        [column],
+                        [Case(*((column == i, merged[i]) for i in sub_ids),
+                                else_=column)],
+                        where=reduce_ids(column, sub_ids)))
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.id, sub_ids)))
+        return True
+
     @classmethod
     def default_level(cls):
         return 'unknown'
 
+    @classmethod
+    def _get_level(cls, code_fips):
+        return LEVELS.get(len(code_fips or ''), 'unknown')
+
     @fields.depends('code_fips')
     def on_change_with_level(self, name=None):
-        levels = { 
-                2: 'state',
-                3: 'county',
-                5: 'place',
-                }
-        return levels.get(len(self.code_fips), 'unknown')
+        return self._get_level(self.code_fips)
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        for values in vlist:
+            values['level'] = cls._get_level(values.get('code_fips'))
+        return super().create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for places, values in zip(actions, actions):
+            if 'code_fips' in values:
+                values = values.copy()
+                values['level'] = cls._get_level(values['code_fips'])
+            args.extend((places, values))
+        super().write(*args)
 
     def get_rec_name(self, name):
         if self.code_fips:
@@ -107,6 +321,13 @@ class Place(tree(), DeactivableMixin, ModelSQL, ModelView):
     @classmethod
     def search_rec_name(cls, name, clause):
         _, operator, operand, *extra = clause
+        if (operator in {'like', 'ilike'} and not extra
+                and isinstance(operand, str)):
+            code_value = lstrip_wildcard(operand)
+            if unescape_wildcard(code_value).rstrip('%').isdigit():
+                # FIPS codes are digits so only a prefix can match them
+                return [('code_fips', 'like', code_value)]
+            return [('id', 'in', cls._search_name_query(operator, operand))]
         if operator.startswith('!') or operator.startswith('not '):
             bool_op = 'AND'
         else:
@@ -118,3 +339,282 @@ class Place(tree(), DeactivableMixin, ModelSQL, ModelView):
             ('code_fips', operator, code_value, *extra),
             ('name', operator, operand, *extra),
             ]
+
+    @classmethod
+    def _search_name_query(cls, operator, value):
+        """Return the query of the places whose name matches value
+
+        In the default language the name column is searched directly so its
+        trigram index can be used, otherwise the translations are joined."""
+        pool = Pool()
+        Configuration = pool.get('ir.configuration')
+        transaction = Transaction()
+        database = transaction.database
+        if transaction.language != Configuration.get_language():
+            return cls.search([('name', operator, value)], query=True)
+        table = cls.__table__()
+        threshold = transaction.context.get(
+            '%s.name.search_similarity' % cls.__name__,
+            transaction.context.get('search_similarity'))
+        field = cls.name
+        column = field._domain_column(operator, field.sql_column(table))
+        if database.has_similarity() and is_full_text(value) and threshold:
+            value = field._domain_value(operator, unescape_wildcard(value))
+            where = database.similarity(column, value) >= threshold
+        else:
+            value = field._domain_value(operator, value)
+            where = fields.SQL_OPERATORS[operator](column, value)
+        return table.select(table.id, where=where)
+
+    @classmethod
+    def autocomplete(cls, text, domain=None, limit=None, order=None):
+        "Rank the matching places and limit them in the database"
+        database = Transaction().database
+        text = text.strip()
+        context = {}
+        if order is None:
+            if text.isdigit():
+                order = [('code_fips', 'ASC'), ('id', 'ASC')]
+            elif database.has_similarity():
+                # Order by the similarity of the name with the text
+                context['%s.name.order' % cls.__name__] = text
+                order = [('name', 'DESC'), ('id', 'ASC')]
+            else:
+                order = [('name', 'ASC'), ('id', 'ASC')]
+        with Transaction().set_context(context):
+            return super().autocomplete(
+                text, domain=domain, limit=limit, order=order)
+
+
+class PlaceCounty(ModelSQL):
+    "Place - County"
+    __name__ = 'census.place-census.place'
+    place = fields.Many2One(
+        'census.place', "Place", required=True, ondelete='CASCADE')
+    county = fields.Many2One(
+        'census.place', "County", required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.place, Index.Equality()),
+                    (t.county, Index.Equality())),
+                Index(t, (t.county, Index.Equality())),
+                })
+
+
+class Boundary(ModelSQL, ModelView):
+    "Place Boundary"
+    __name__ = 'census.place.boundary'
+    # The cache only stores the stamp of the indexes which are kept by
+    # database and type to not be copied on each lookup
+    _index_cache = Cache(__name__ + '.index', context=False)
+    _indexes = {}
+    _index_stamps = count()
+
+    subdivision = fields.Many2One(
+        'country.subdivision', "Subdivision", required=True,
+        ondelete='CASCADE')
+    type = fields.Selection([
+            ('address', "Address"),
+            ('zip', "ZIP Code"),
+            ('zip4', "ZIP+4"),
+            ], "Type", required=True)
+    start_date = fields.Date("Start Date")
+    end_date = fields.Date("End Date")
+    low = fields.Integer("Low", required=True,
+        help="The lowest house number or ZIP+4 as a number of the range.")
+    high = fields.Integer("High", required=True,
+        help="The highest house number or ZIP+4 as a number of the range.")
+    parity = fields.Selection([
+            ('odd', "Odd"),
+            ('even', "Even"),
+            ('both', "Both"),
+            ], "Parity")
+    street = fields.Char("Street",
+        help="The normalized street of the address range.")
+    zip = fields.Char("ZIP Code", size=5)
+    place = fields.Many2One(
+        'census.place', "Place", required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.subdivision, Index.Equality()),
+                    (t.type, Index.Equality())),
+                Index(
+                    t,
+                    (t.type, Index.Equality()),
+                    (t.low, Index.Range())),
+                })
+        cls.__rpc__.update({
+                'places_by_zip': RPC(),
+                'places_by_address': RPC(),
+                })
+
+    @classmethod
+    def default_parity(cls):
+        return 'both'
+
+    @staticmethod
+    def normalize_street(street):
+        return ' '.join((street or '').upper().split())
+
+    @classmethod
+    def _get_index(cls, type_):
+        """Return the ranges of the type
+
+        The ranges of each key are stored as arrays of lows, highs, running
+        maximum of the highs, first and last days and place ids sorted by
+        low. The key is None for the ZIP codes and the ZIP code, street and
+        parity for the addresses."""
+        database = Transaction().database.name
+        stamp = cls._index_cache.get(type_)
+        if stamp is None:
+            stamp = next(cls._index_stamps)
+            cls._index_cache.set(type_, stamp)
+        cached = cls._indexes.get((database, type_))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(
+                table.zip, table.street, table.parity,
+                table.low, table.high, table.start_date, table.end_date,
+                table.place,
+                where=table.type == type_,
+                order_by=[table.low.asc, table.id.asc]))
+        index = {}
+        for (zip_, street, parity, low, high, start_date, end_date,
+                place) in cursor:
+            if type_ == 'address':
+                parities = ['odd', 'even'] if parity == 'both' else [parity]
+                keys = [(zip_, street, p) for p in parities]
+            else:
+                keys = [None]
+            for key in keys:
+                lows, highs, maxima, starts, ends, places = index.setdefault(
+                    key, tuple(array('q') for _ in range(6)))
+                lows.append(low)
+                highs.append(high)
+                maxima.append(max(high, maxima[-1]) if maxima else high)
+                starts.append(_day(start_date, 0))
+                ends.append(_day(end_date, dt.date.max.toordinal()))
+                places.append(place)
+        cls._indexes[database, type_] = (stamp, index)
+        return index
+
+    @staticmethod
+    def _search_index(index, key, value, date):
+        "Return the place of the last range of key containing value at date"
+        if key not in index:
+            return
+        lows, highs, maxima, starts, ends, places = index[key]
+        day = date.toordinal()
+        i = bisect_right(lows, value) - 1
+        # The ranges before i can not contain value once their maximum high
+        # is lower
+        while i >= 0 and maxima[i] >= value:
+            if value <= highs[i] and starts[i] <= day <= ends[i]:
+                return places[i]
+            i -= 1
+
+    @classmethod
+    def places_by_zip(cls, codes, date=None):
+        """Return the place id of each ZIP or ZIP+4 code
+
+        The ZIP+4 ranges are searched before the ZIP code ranges. The id is
+        None when no range contains the code."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if date is None:
+            date = Date.today()
+        zip4 = cls._get_index('zip4')
+        zip5 = cls._get_index('zip')
+        result = []
+        for code in codes:
+            value = _zip_value(code)
+            place = None
+            if value is not None:
+                if len(code.replace('-', '').strip()) > 5:
+                    place = cls._search_index(zip4, None, value, date)
+                if place is None:
+                    place = cls._search_index(zip5, None, value, date)
+            result.append(place)
+        return result
+
+    @classmethod
+    def places_by_address(cls, addresses, date=None):
+        """Return the place id of each (number, street, ZIP code) address
+
+        An address which is not in any address range is resolved by its ZIP
+        code."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if date is None:
+            date = Date.today()
+        index = cls._get_index('address')
+        result, unknowns = [], []
+        for i, (number, street, code) in enumerate(addresses):
+            place = None
+            zip_ = (code or '').strip()[:5]
+            try:
+                number = int(number)
+            except (TypeError, ValueError):
+                pass
+            else:
+                parity = 'odd' if number % 2 else 'even'
+                place = cls._search_index(
+                    index, (zip_, cls.normalize_street(street), parity),
+                    number, date)
+            if place is None:
+                unknowns.append(i)
+            result.append(place)
+        if unknowns:
+            places = cls.places_by_zip(
+                [addresses[i][2] for i in unknowns], date=date)
+            for i, place in zip(unknowns, places):
+                result[i] = place
+        return result
+
+    @classmethod
+    def create(cls, vlist):
+        boundaries = super().create(vlist)
+        cls._index_cache.clear()
+        return boundaries
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._index_cache.clear()
+
+    @classmethod
+    def delete(cls, boundaries):
+        super().delete(boundaries)
+        cls._index_cache.clear()
+
+    @classmethod
+    def _after_sql_insert(cls, ids):
+        "Clear the indexes after boundaries are inserted with raw SQL"
+        cls._index_cache.clear()
+
+
+def _zip_value(code):
+    "Return the ZIP or ZIP+4 code as a number of nine digits"
+    code = (code or '').replace('-', '').strip()
+    if not code.isdigit() or len(code) not in {5, 9}:
+        return
+    return int(code.ljust(9, '0'))
+
+
+def _day(date, default):
+    "Return the ordinal of the date or default when it is None"
+    return date.toordinal() if date is not None else default
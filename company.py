@@ -0,0 +1,37 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+from .tax import RATE_TYPES
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+    sstp_rate_types = fields.MultiSelection([
+            ('general_rate_intrastate', "General Intrastate"),
+            ('general_rate_interstate', "General Interstate"),
+            ('food_rate_intrastate', "Food Intrastate"),
+            ('food_rate_interstate', "Food Interstate"),
+            ], "SSTP Rate Types",
+        help="The SSTP rate types for which taxes are created.")
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table_h = cls.__table_handler__(module_name)
+        rate_types_exist = table_h.column_exist('sstp_rate_types')
+
+        super().__register__(module_name)
+
+        # Migration from 7.2: keep the taxes of all the rate types
+        if not rate_types_exist:
+            cursor.execute(*table.update(
+                    [table.sstp_rate_types],
+                    [cls.sstp_rate_types.sql_format(RATE_TYPES)]))
+
+    @classmethod
+    def default_sstp_rate_types(cls):
+        return ['general_rate_intrastate']
@@ -0,0 +1,118 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import hashlib
+import json
+import os
+import tempfile
+from email.message import Message
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
+from urllib.response import addinfourl
+
+BUFFER_SIZE = 64 * 1024
+
+
+def _digest(value):
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class Fetcher(object):
+    """Open URLs directly, through a local cache or from an offline source
+
+    The cache directory stores each downloaded file once under the SHA-256
+    of its content and the metadata of each URL (final URL, ETag and
+    Last-Modified) in a separate file, which is used to send conditional
+    requests. The source directory contains previously downloaded files
+    named after the last component of their URL and is used without any
+    network access. The mirror is a base URL under which the files are
+    requested instead, by host and path."""
+
+    def __init__(self, cache=None, source=None, mirror=None):
+        self.cache = cache
+        self.source = source
+        self.mirror = mirror
+
+    def urlopen(self, url):
+        if self.mirror:
+            url = self._mirror_url(url)
+        if self.source:
+            return self._open_source(url)
+        elif self.cache:
+            return self._open_cache(url)
+        return urlopen(url)
+
+    def _mirror_url(self, url):
+        parts = urlparse(url)
+        return urljoin(
+            self.mirror.rstrip('/') + '/', parts.netloc + parts.path)
+
+    def listdir(self):
+        "Return the names of the files in the offline source"
+        return sorted(os.listdir(self.source))
+
+    def _open_source(self, url):
+        name = os.path.basename(urlparse(url).path)
+        path = os.path.join(self.source, name)
+        if not name or not os.path.isfile(path):
+            raise HTTPError(url, 404, "Not found in %s" % self.source,
+                Message(), None)
+        return addinfourl(open(path, 'rb'), Message(), url, 200)
+
+    def _open_cache(self, url):
+        meta_path = os.path.join(self.cache, 'urls', _digest(url) + '.json')
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if not os.path.exists(self._object_path(meta['sha256'])):
+                meta = None
+
+        request = Request(url)
+        if meta:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if e.code == 304 and meta:
+                return self._open_object(meta)
+            raise
+        except URLError:
+            if meta:
+                return self._open_object(meta)
+            raise
+
+        with response:
+            objects = os.path.join(self.cache, 'objects')
+            os.makedirs(objects, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=objects)
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: response.read(BUFFER_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            meta = {
+                'url': response.url,
+                'sha256': digest.hexdigest(),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                }
+            os.replace(tmp, self._object_path(meta['sha256']))
+
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(meta_path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+        return self._open_object(meta)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.cache, 'objects', sha256)
+
+    def _open_object(self, meta):
+        return addinfourl(
+            open(self._object_path(meta['sha256']), 'rb'), Message(),
+            meta['url'], 200)
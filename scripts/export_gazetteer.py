@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import os
+import sys
+from argparse import ArgumentParser
+
+try:
+    from proteus import config
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("proteus must be installed to use %s" % prog)
+
+try:
+    from .gazetteer import Place, write
+    from .loader import LOADERS, get_loader
+except ImportError:
+    from gazetteer import Place, write
+    from loader import LOADERS, get_loader
+
+FIELDS = ['id', 'subdivision.code', 'code_fips', 'code_gnis', 'name',
+    'parent', 'class_code.code']
+
+def get_places(loader):
+    "Yield the gazetteer Place of each active census place"
+    for values in loader.search_read('census.place', [], FIELDS):
+        subdivision = values.get('subdivision.') or {}
+        class_code = values.get('class_code.') or {}
+        yield Place(
+            id=values['id'],
+            subdivision=subdivision.get('code'),
+            code_fips=values['code_fips'],
+            code_gnis=values['code_gnis'],
+            name=values['name'],
+            parent=values['parent'],
+            class_code=class_code.get('code'))
+
+def main(database, filename, config_file=None, loader='proteus',
+        language=None):
+    config.set_trytond(database, config_file=config_file)
+    context = {'language': language} if language else {}
+    with config.get_config().set_context(context):
+        count = write(filename, get_places(get_loader(loader)))
+    print("%d places exported to %s" % (count, filename), file=sys.stderr)
+
+def run():
+    parser = ArgumentParser(
+        description="Export the census places into a gazetteer file")
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-c', '--config', dest='config_file',
+        help='the trytond config file')
+    parser.add_argument('-l', '--loader', dest='loader', choices=LOADERS,
+        default='proteus', help='how the places are read')
+    parser.add_argument('--language', dest='language',
+        help='the language of the names instead of the user one')
+    parser.add_argument('filename')
+
+    args = parser.parse_args()
+    main(args.database, args.filename, args.config_file, loader=args.loader,
+        language=args.language)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,209 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Compact gazetteer of the census places read through a memory map
+
+The file stores one fixed size record per place sorted by id, a heap of the
+UTF-8 strings and the sorted record numbers by FIPS code, GNIS code and
+case-folded name. The lookups are binary searches directly on the mapped
+pages, so the file is never loaded as a whole and the processes reading the
+same file share the page cache."""
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+
+MAGIC = b'SSTPGAZ1'
+# magic, count, offsets of the records, heap, FIPS, GNIS and name indexes
+HEADER = struct.Struct('<8sI5Q')
+# id, parent, GNIS code and the offset and length in the heap of the
+# subdivision code, FIPS code, name and class code
+RECORD = struct.Struct('<IIi' + 'IH' * 4)
+INDEX = struct.Struct('<I')
+
+Place = namedtuple('Place', ['id', 'subdivision', 'code_fips', 'code_gnis',
+        'name', 'parent', 'class_code'])
+
+
+def _name_key(name):
+    return name.casefold()
+
+
+def write(filename, places):
+    """Write the gazetteer of places into filename
+
+    places is an iterable of Place. The file is written next to filename and
+    renamed, so the readers keep a consistent mapping of the previous one."""
+    places = sorted(places, key=lambda p: p.id)
+    heap = bytearray()
+    strings = {}
+
+    def add(value):
+        value = value or ''
+        if value not in strings:
+            data = value.encode('utf-8')
+            strings[value] = (len(heap), len(data))
+            heap.extend(data)
+        return strings[value]
+
+    records = bytearray()
+    for place in places:
+        records += RECORD.pack(place.id, place.parent or 0,
+            place.code_gnis or 0,
+            *add(place.subdivision), *add(place.code_fips),
+            *add(place.name), *add(place.class_code))
+
+    numbers = range(len(places))
+    indexes = [
+        sorted(numbers, key=lambda i: (
+                places[i].code_fips or '', places[i].subdivision or '')),
+        sorted(
+            (i for i in numbers if places[i].code_gnis),
+            key=lambda i: places[i].code_gnis),
+        sorted(numbers, key=lambda i: _name_key(places[i].name or '')),
+        ]
+
+    offset = HEADER.size
+    offsets = [offset, offset + len(records)]
+    offset = offsets[-1] + len(heap)
+    chunks = [records, heap]
+    for index in indexes:
+        offsets.append(offset)
+        chunks.append(struct.pack('<%dI' % len(index), *index))
+        offset += len(index) * INDEX.size
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.gazetteer')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(places), *offsets))
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(places)
+
+
+class Gazetteer(object):
+    "Read the places of a gazetteer file"
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self._count, self._records, self._heap, *indexes
+            ) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError("%s is not a gazetteer file" % filename)
+        self._fips, self._gnis, self._names = indexes
+        self._gnis_count = (self._names - self._gnis) // INDEX.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._place(i)
+
+    def _string(self, offset, length):
+        start = self._heap + offset
+        return self._map[start:start + length].decode('utf-8')
+
+    def _unpack(self, i):
+        return RECORD.unpack_from(self._map, self._records + i * RECORD.size)
+
+    def _place(self, i):
+        (id_, parent, code_gnis, subdivision_offset, subdivision_length,
+            fips_offset, fips_length, name_offset, name_length,
+            class_offset, class_length) = self._unpack(i)
+        return Place(
+            id=id_,
+            subdivision=self._string(
+                subdivision_offset, subdivision_length) or None,
+            code_fips=self._string(fips_offset, fips_length) or None,
+            code_gnis=code_gnis or None,
+            name=self._string(name_offset, name_length),
+            parent=parent or None,
+            class_code=self._string(class_offset, class_length) or None)
+
+    def _number(self, index, position):
+        return INDEX.unpack_from(self._map, index + position * INDEX.size)[0]
+
+    def _bisect(self, count, key, value):
+        "Return the first position of the count keys not lower than value"
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, id_):
+        "Return the place with id_ or None"
+        i = self._bisect(self._count, lambda i: self._unpack(i)[0], id_)
+        if i < self._count and self._unpack(i)[0] == id_:
+            return self._place(i)
+
+    def _fips_key(self, position):
+        record = self._unpack(self._number(self._fips, position))
+        return self._string(*record[5:7])
+
+    def by_fips(self, code, subdivision=None, prefix=False):
+        """Return the places with the FIPS code
+
+        With prefix, the places with a FIPS code starting with code are
+        returned."""
+        start = self._bisect(self._count, self._fips_key, code)
+        result = []
+        for position in range(start, self._count):
+            value = self._fips_key(position)
+            if not (value.startswith(code) if prefix else value == code):
+                break
+            place = self._place(self._number(self._fips, position))
+            if subdivision is None or place.subdivision == subdivision:
+                result.append(place)
+        return result
+
+    def by_gnis(self, code):
+        "Return the place with the GNIS code or None"
+        count = self._gnis_count
+
+        def key(position):
+            return self._unpack(self._number(self._gnis, position))[2]
+        position = self._bisect(count, key, code)
+        if position < count and key(position) == code:
+            return self._place(self._number(self._gnis, position))
+
+    def by_name(self, name, prefix=False, limit=None):
+        """Return the places named name ignoring the case
+
+        With prefix, the places with a name starting with name are returned
+        in the order of their names."""
+        name = _name_key(name)
+
+        def key(position):
+            record = self._unpack(self._number(self._names, position))
+            return _name_key(self._string(*record[7:9]))
+        result = []
+        for position in range(
+                self._bisect(self._count, key, name), self._count):
+            if limit is not None and len(result) >= limit:
+                break
+            value = key(position)
+            if not (value.startswith(name) if prefix else value == name):
+                break
+            result.append(self._place(self._number(self._names, position)))
+        return result
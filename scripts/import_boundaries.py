@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import csv
+import datetime as dt
+import os
+import shutil
+import sys
+import zipfile
+from argparse import ArgumentParser
+from collections import namedtuple
+from contextlib import contextmanager
+from io import TextIOWrapper
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+
+try:
+    from proteus import config
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("proteus must be installed to use %s" % prog)
+
+try:
+    from .cache import Fetcher
+    from .import_rates import LinksExtractor
+    from .loader import LOADERS, get_loader
+    from .metrics import Metrics, profile
+except ImportError:
+    from cache import Fetcher
+    from import_rates import LinksExtractor
+    from loader import LOADERS, get_loader
+    from metrics import Metrics, profile
+
+# Default number of boundaries saved (and committed) per call
+CHUNK_SIZE = 5000
+# Size above which downloaded archives are spooled to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024
+BASE_URL = 'https://www.streamlinedsalestax.org/ratesandboundry/Boundaries/'
+
+fetcher = Fetcher()
+loader = get_loader()
+metrics = Metrics()
+metrics.loader = loader
+
+_fieldnames = ['record_type', 'start_date', 'end_date', 'low_address',
+    'high_address', 'odd_even', 'street_pre_directional', 'street_name',
+    'street_suffix', 'street_post_directional', 'secondary_abbreviation',
+    'secondary_low', 'secondary_high', 'secondary_odd_even', 'city_name',
+    'zip_code', 'plus_4', 'zip_code_low', 'zip_extension_low',
+    'zip_code_high', 'zip_extension_high', 'composite_ser_code',
+    'fips_state_code', 'fips_state_indicator', 'fips_county_code',
+    'fips_place_code', 'fips_place_class_code', 'longitude', 'latitude']
+Row = namedtuple('Row', _fieldnames)
+_parities = {'O': 'odd', 'E': 'even', 'B': 'both'}
+
+def _get_files():
+    "Return the URL of the boundaries file of each state code"
+    if not _files:
+        if fetcher.source:
+            links = [n for n in fetcher.listdir()
+                if n[2:3] == 'B'
+                and os.path.splitext(n)[1] in {'.zip', '.csv'}]
+        else:
+            try:
+                responce = fetcher.urlopen(BASE_URL)
+            except HTTPError as e:
+                sys.exit(
+                    "\nError fetching directory listing: %s" % e.reason)
+            parser = LinksExtractor()
+            with responce:
+                parser.feed(TextIOWrapper(responce, encoding='utf-8').read())
+            parser.close()
+            links = parser.get_links()
+        _files.update(
+            (os.path.basename(a)[:2], urljoin(BASE_URL, a)) for a in links)
+    return _files
+_files = {}
+
+@contextmanager
+def fetch_stream(code):
+    "Yield the boundaries CSV of code as a binary stream"
+    sys.stderr.write('Fetching')
+    with metrics.phase('fetch', code):
+        try:
+            url = _get_files()[code]
+        except KeyError:
+            sys.exit("\nFile not found for code: %s" % code)
+        try:
+            responce = fetcher.urlopen(url)
+        except HTTPError as e:
+            sys.exit("\nError downloading %s: %s" % (code, e.reason))
+    with responce:
+        root, ext = os.path.splitext(responce.url)
+        if ext == '.zip':
+            with SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+                with metrics.phase('fetch', code):
+                    shutil.copyfileobj(responce, spool, BUFFER_SIZE)
+                spool.seek(0)
+                print('.', file=sys.stderr)
+                with zipfile.ZipFile(spool) as zf, \
+                        zf.open(os.path.basename(root) + '.csv') as f:
+                    yield f
+        else:
+            print('.', file=sys.stderr)
+            yield responce
+
+def read_rows(f):
+    "Yield a Row for each line of the binary CSV stream f"
+    size = len(_fieldnames)
+    for values in csv.reader(TextIOWrapper(f, encoding='utf-8')):
+        if not values:
+            continue
+        values = (values + [''] * size)[:size]
+        yield Row._make(v.strip() for v in values)
+
+def _date(value):
+    if value:
+        return dt.datetime.strptime(value, '%Y%m%d').date()
+
+def get_subdivision(code):
+    subdivisions = loader.search_read('country.subdivision', [
+            ('code', '=', 'US-%s' % code),
+            ], ['id'])
+    if not subdivisions:
+        sys.exit("Error missing subdivision with code US-%s" % code)
+    return subdivisions[0]['id']
+
+def get_places(code):
+    return {p['code_fips']: p['id']
+        for p in loader.search_read('census.place', [
+                ('subdivision.code', '=', 'US-%s' % code),
+                ], ['code_fips'])}
+
+def get_values(row, subdivision, places):
+    "Return the values of the boundary of row or None if it is not supported"
+    place = (places.get(row.fips_place_code)
+        or places.get(row.fips_county_code)
+        or places.get(row.fips_state_code))
+    if not place:
+        return
+    values = {
+        'subdivision': subdivision,
+        'start_date': _date(row.start_date),
+        'end_date': _date(row.end_date),
+        'place': place,
+        }
+    if row.record_type == 'A':
+        values.update({
+                'type': 'address',
+                'low': int(row.low_address),
+                'high': int(row.high_address),
+                'parity': _parities.get(row.odd_even, 'both'),
+                'street': ' '.join(p.upper() for p in [
+                            row.street_pre_directional, row.street_name,
+                            row.street_suffix, row.street_post_directional]
+                        if p),
+                'zip': row.zip_code,
+                })
+    elif row.record_type == 'Z':
+        values.update({
+                'type': 'zip',
+                'low': int(row.zip_code_low) * 10000,
+                'high': int(row.zip_code_high) * 10000 + 9999,
+                })
+    elif row.record_type == '4':
+        values.update({
+                'type': 'zip4',
+                'low': int(row.zip_code_low + row.zip_extension_low),
+                'high': int(row.zip_code_high + row.zip_extension_high),
+                })
+    else:
+        return
+    return values
+
+def delete_boundaries(code, batch_size=CHUNK_SIZE):
+    "Delete the boundaries of the state code"
+    ids = [b['id'] for b in loader.search_read('census.place.boundary', [
+                ('subdivision.code', '=', 'US-%s' % code),
+                ], ['id'])]
+    for i in range(0, len(ids), batch_size):
+        loader.delete('census.place.boundary', ids[i:i + batch_size])
+    return len(ids)
+
+def import_state(code, batch_size=None):
+    """Replace the boundaries of the state code by those of its file
+
+    The boundaries are deleted first and created by chunks, so the state has
+    partial boundaries until the import is finished."""
+    if batch_size is None:
+        batch_size = CHUNK_SIZE
+    print(code, file=sys.stderr)
+    subdivision = get_subdivision(code)
+    with metrics.phase('get_places', code) as phase:
+        places = get_places(code)
+        phase['rows'] += len(places)
+    with metrics.phase('delete', code) as phase:
+        phase['rows'] += delete_boundaries(code, batch_size)
+
+    created = skipped = 0
+    with fetch_stream(code) as f:
+        rows = metrics.iterate('parse', code, read_rows(f))
+        while True:
+            with metrics.phase('build', code) as phase:
+                vlist = []
+                for row in islice(rows, batch_size):
+                    values = get_values(row, subdivision, places)
+                    if values is None:
+                        skipped += 1
+                    else:
+                        vlist.append(values)
+                phase['rows'] += len(vlist)
+            if not vlist:
+                break
+            with metrics.phase('save', code) as phase:
+                loader.create('census.place.boundary', vlist)
+                phase['rows'] += len(vlist)
+            created += len(vlist)
+            sys.stderr.write('.')
+    print('', file=sys.stderr)
+    print("%s: %d created, %d skipped" % (code, created, skipped),
+        file=sys.stderr)
+
+def set_loader(name):
+    global loader
+    loader = get_loader(name)
+    metrics.loader = loader
+
+def main(database, codes, config_file=None, batch_size=None, cache=None,
+        source=None, loader='proteus', mirror=None, metrics_file=None,
+        profile_file=None, trace_memory=False):
+    config.set_trytond(database, config_file=config_file)
+    metrics.install(config.get_config(), trace_memory=trace_memory)
+    fetcher.cache, fetcher.source, fetcher.mirror = cache, source, mirror
+    set_loader(loader)
+    codes = [c.upper() for c in codes]
+    try:
+        with profile(profile_file):
+            for code in codes:
+                import_state(code, batch_size=batch_size)
+    finally:
+        if metrics_file:
+            metrics.dump(metrics_file, script='import_boundaries',
+                codes=codes, loader=loader)
+
+def run():
+    parser = ArgumentParser(
+        description="Import the SSTP boundaries of the states")
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-c', '--config', dest='config_file',
+        help='the trytond config file')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+        default=CHUNK_SIZE,
+        help='the number of boundaries saved and committed at once')
+    parser.add_argument('--cache', dest='cache',
+        help='the directory caching the downloaded files')
+    parser.add_argument('--source', dest='source',
+        help='the directory of previously downloaded files to use offline')
+    parser.add_argument('--mirror', dest='mirror',
+        help='the base URL from which the files are downloaded by host '
+        'and path instead')
+    parser.add_argument('-l', '--loader', dest='loader', choices=LOADERS,
+        default='proteus',
+        help='how the records are saved: through proteus, with the trytond '
+        'ORM in the same process or with raw SQL inserts')
+    parser.add_argument('--metrics', dest='metrics_file', metavar='FILE',
+        help='write the duration, rows and calls of each phase and state '
+        'and the peak memory as JSON into FILE')
+    parser.add_argument('--trace-memory', dest='trace_memory',
+        action='store_true',
+        help='write the peak memory of each phase into the metrics, '
+        'which slows the import down')
+    parser.add_argument('--profile', dest='profile_file', metavar='FILE',
+        help='write the cProfile statistics into FILE')
+    parser.add_argument('codes', nargs='+')
+
+    args = parser.parse_args()
+    main(args.database, args.codes, args.config_file,
+        batch_size=args.batch_size, cache=args.cache, source=args.source,
+        loader=args.loader, mirror=args.mirror,
+        metrics_file=args.metrics_file, profile_file=args.profile_file,
+        trace_memory=args.trace_memory)
+
+if __name__ == '__main__':
+    run()
@@ -9,9 +9,8 @@ from argparse import ArgumentParser
 
 try:
     from urllib.error import HTTPError
-    from urllib.request import urlopen
 except ImportError:
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import HTTPError
 
 from io import BytesIO, TextIOWrapper
 
@@ -31,6 +30,15 @@ except ImportError:
     prog = os.path.basename(sys.argv[0])
     sys.exit("proteus must be installed to use %s" % prog)
 
+try:
+    from .cache import Fetcher
+    from .loader import LOADERS, get_loader
+    from .metrics import Metrics, profile
+except ImportError:
+    from cache import Fetcher
+    from loader import LOADERS, get_loader
+    from metrics import Metrics, profile
+
 DIVISIONS = {
     'D1': ['09', '23', '25', '33', '44', '50'],
     'D2': ['34', '36', '42'],
@@ -44,6 +52,11 @@ DIVISIONS = {
     }
 REGION2PARENT = {c: p for p, r in DIVISIONS.items() for c in r}
 
+fetcher = Fetcher()
+loader = get_loader()
+metrics = Metrics()
+metrics.loader = loader
+
 def _progress(iterable):
     if ProgressBar:
         pbar = ProgressBar(
@@ -60,17 +73,22 @@ def _get_language_codes():
 
 def fetch(url):
     sys.stderr.write('Fetching')
-    try:
-        responce = urlopen(url)
-    except HTTPError as e:
-        sys.exit("\nError downloading %s: %s" % (url, e.reason))
-    data = responce.read()
+    with metrics.phase('fetch'):
+        try:
+            responce = fetcher.urlopen(url)
+        except HTTPError as e:
+            sys.exit("\nError downloading %s: %s" % (url, e.reason))
+        with responce:
+            data = responce.read()
     print('.', file=sys.stderr)
     return data
 
 def get_states(code):
     Place = Model.get('census.place')
-    return {c.code_fips: c for c in Place.find([('country.code', '=', code)])}
+    return {c.code_fips: c for c in Place.find([
+                ('country.code', '=', code),
+                ('parent', '=', None),
+                ])}
 
 def update_states(code, states):
     print("Update states", file=sys.stderr)
@@ -104,7 +122,8 @@ def update_states(code, states):
 
     country = get_country(code)
 
-    code2region = {a.code: a for a in CensusRegion.find([])}
+    code2region = {c: CensusRegion(i) for c, i in CensusRegion.code2id(
+            config.get_config().context).items()}
 
     data = fetch('https://www2.census.gov/geo/docs/reference/codes2020/national_state2020.txt')
     f= TextIOWrapper(BytesIO(data), encoding='utf-8')
@@ -126,124 +145,232 @@ def update_states(code, states):
     Place.save(records)
     return {c.code_fips: c for c in records}
 
-def get_counties(code):
-    Place = Model.get('census.place')
-    return {(c.subdivision.code, c.code_fips): c for c in Place.find([])}
-#    return {(c.subdivision.code, c.code_fips): c for c in Place.find([('subdivision.code', '=', code)])}
-
-def update_counties(states, counties):
+def _search_keys(domain):
+    "Return the id of the places matching domain keyed by subdivision and FIPS"
+    return {(p['subdivision.']['code'], p['code_fips']): p['id']
+        for p in loader.search_read('census.place', domain,
+            ['code_fips', 'subdivision.code'])}
+
+def _get_class_code(class_codes, code, unknown_class_codes):
+    if code in class_codes:
+        return class_codes[code]
+    if code not in unknown_class_codes:
+        print("Unknown class code: %s" % code, file=sys.stderr)
+        unknown_class_codes.add(code)
+
+def _save_places(to_create, to_write):
+    "Create and write the places and return the ids of the created"
+    if to_write:
+        loader.write('census.place', *to_write)
+    if to_create:
+        return loader.create('census.place', to_create)
+    return []
+
+def get_counties(codes):
+    return _search_keys([
+            ('subdivision.code', 'in', codes),
+            ('level', '=', 'county'),
+            ])
+
+def update_counties(codes, states, counties):
     print("Update counties", file=sys.stderr)
     ClassCode = Model.get('census.class_code')
-    Place = Model.get('census.place')
 
     # 'https://www2.census.gov/geo/docs/reference/codes2020/cou/st49_ut_cou2020.txt' 
     data = fetch('https://www2.census.gov/geo/docs/reference/codes2020/national_county2020.txt')
     f= TextIOWrapper(BytesIO(data), encoding='utf-8')
 
-    class_codes = {c.code: c for c in ClassCode.find([])}
+    class_codes = ClassCode.code2id(config.get_config().context)
     unknown_class_codes = set()
-    records = []
+    to_create, to_write, keys = [], [], []
     for row in _progress(list(csv.DictReader(f, delimiter='|'))):
         state = states[row['STATEFP']]
-        subdivision_code = state.subdivision.code
+        if not state.subdivision or state.subdivision.code not in codes:
+            continue
+        code = state.subdivision.code
         county_fips = row['COUNTYFP']
-        if (subdivision_code, county_fips) in counties:
-            record = counties[(subdivision_code, county_fips)]
+        key = (code, county_fips)
+        values = {
+            'name': row['COUNTYNAME'],
+            'code_gnis': int(row['COUNTYNS']),
+            'parent': state.id,
+            'region': state.region.id if state.region else None,
+            'class_code': _get_class_code(
+                class_codes, row['CLASSFP'], unknown_class_codes),
+            }
+        if key in counties:
+            to_write.extend([[counties[key]], values])
         else:
-            record = Place(code_fips=county_fips,
-                    subdivision=state.subdivision, country=state.country)
-        record.name = row['COUNTYNAME']
-        record.code_gnis = int(row['COUNTYNS'])
-        class_code = row['CLASSFP']
-        record.parent = state
-        record.region = state.region
-        if class_code in class_codes:
-            record.class_code = class_codes[class_code]
-        else:
-            record.class_code = None
-            if class_code not in unknown_class_codes:
-                print("Unknown class code: %s" % class_code,
-                        file=sys.stderr)
-                unknown_class_codes.add(class_code)
-        records.append(record)
-
-    Place.save(records)
-    return {(c.subdivision.code, c.code_fips): c for c in records}
-
-def get_places(code):
-    Place = Model.get('census.place')
-    #return {c.code_fips: c for c in Place.find([('level', '=', level)])}
-    return {(c.subdivision.code, c.code_fips): c for c in Place.find([])}
-
-def update_places(states, counties, places):
+            values.update({
+                    'code_fips': county_fips,
+                    'level': 'county',
+                    'subdivision': state.subdivision.id,
+                    'country': state.country.id,
+                    })
+            to_create.append(values)
+            keys.append(key)
+
+    counties.update(zip(keys, _save_places(to_create, to_write)))
+    return counties
+
+def get_places(codes):
+    return _search_keys([
+            ('subdivision.code', 'in', codes),
+            ('level', '=', 'place'),
+            ])
+
+def update_places(codes, states, counties, places):
     print("Update places", file=sys.stderr)
     ClassCode = Model.get('census.class_code')
-    Place = Model.get('census.place')
 
     # 'https://www2.census.gov/geo/docs/reference/codes2020/place_by_cou/st49_ut_place_by_county2020.txt'
     data = fetch('https://www2.census.gov/geo/docs/reference/codes2020/national_place_by_county2020.txt')
     f= TextIOWrapper(BytesIO(data), encoding='utf-8')
 
-    class_codes = {c.code: c for c in ClassCode.find([])}
+    class_codes = ClassCode.code2id(config.get_config().context)
     unknown_class_codes = set()
-    records = []
+    to_create, to_write, keys = [], [], []
+    other_counties = {}
     for row in _progress(list(csv.DictReader(f, delimiter='|'))):
         state = states[row['STATEFP']]
-        subdivision_code = state.subdivision.code
-        county = counties[(subdivision_code, row['COUNTYFP'])]
+        if not state.subdivision or state.subdivision.code not in codes:
+            continue
+        code = state.subdivision.code
         place_fips = row['PLACEFP']
-        if (subdivision_code, place_fips) in places:
-            record = places[(subdivision_code, place_fips)]
+        key = (code, place_fips)
+        county = counties[(code, row['COUNTYFP'])]
+        # A place spanning several counties is under the first one and the
+        # others are stored as its other counties
+        if key in other_counties:
+            other_counties[key].append(county)
+            continue
+        other_counties[key] = []
+        values = {
+            'name': row['PLACENAME'],
+            'code_gnis': int(row['PLACENS']),
+            'parent': county,
+            'region': state.region.id if state.region else None,
+            'class_code': _get_class_code(
+                class_codes, row['CLASSFP'], unknown_class_codes),
+            }
+        if key in places:
+            to_write.extend([[places[key]], values])
         else:
-            record = Place(code_fips=place_fips,
-                    subdivision=state.subdivision, country=state.country)
-        record.name = row['PLACENAME']
-        record.code_gnis = int(row['PLACENS'])
-        class_code = row['CLASSFP']
-        record.parent = county
-        record.region = state.region
-        if class_code in class_codes:
-            record.class_code = class_codes[class_code]
-        else:
-            record.class_code = None
-            if class_code not in unknown_class_codes:
-                print("Unknown class code: %s" % class_code,
-                        file=sys.stderr)
-                unknown_class_codes.add(class_code)
-        records.append(record)
-
-    Place.save(records)
-
-def main(database, codes, config_file=None):
+            values.update({
+                    'code_fips': place_fips,
+                    'level': 'place',
+                    'subdivision': state.subdivision.id,
+                    'country': state.country.id,
+                    })
+            to_create.append(values)
+            keys.append(key)
+
+    places.update(zip(keys, _save_places(to_create, to_write)))
+    update_other_counties(codes, {
+            places[k]: c for k, c in other_counties.items()})
+    return places
+
+def update_other_counties(codes, other_counties):
+    "Set the other counties of the places of codes by place id"
+    existing = {p['id']: set(p['counties'])
+        for p in loader.search_read('census.place', [
+                ('subdivision.code', 'in', sorted(codes)),
+                ('counties', '!=', None),
+                ], ['counties'])}
+    to_write = []
+    for place in sorted(set(existing) | set(other_counties)):
+        old = existing.get(place, set())
+        new = set(other_counties.get(place, []))
+        if old != new:
+            to_write.extend([[place], {'counties': [
+                            ('remove', sorted(old - new)),
+                            ('add', sorted(new - old)),
+                            ]}])
+    if to_write:
+        loader.write('census.place', *to_write)
+
+def set_loader(name):
+    global loader
+    loader = get_loader(name)
+    metrics.loader = loader
+
+def main(database, codes, config_file=None, cache=None, source=None,
+        loader='proteus', mirror=None, metrics_file=None, profile_file=None,
+        trace_memory=False):
     config.set_trytond(database, config_file=config_file)
-    with config.get_config().set_context(active_test=False):
-        do_import(codes)
+    metrics.install(config.get_config(), trace_memory=trace_memory)
+    fetcher.cache, fetcher.source, fetcher.mirror = cache, source, mirror
+    set_loader(loader)
+    try:
+        with config.get_config().set_context(active_test=False), \
+                profile(profile_file):
+            do_import(codes)
+    finally:
+        if metrics_file:
+            metrics.dump(metrics_file, script='import_places',
+                codes=[c.upper() for c in codes], loader=loader)
 
 def do_import(codes):
-    states = get_states('US')
-    states = update_states('US', states)
+    "Import the places of codes, the update phases include their fetch"
+    with metrics.phase('get_states') as phase:
+        states = get_states('US')
+        phase['rows'] += len(states)
+    with metrics.phase('update_states') as phase:
+        states = update_states('US', states)
+        phase['rows'] += len(states)
     #translate_states(states)
 
-    for code in codes:
-        print(code, file=sys.stderr)
-        code = 'US-%s' % code.upper()
-        counties = get_counties(code)
-        counties = update_counties(states, counties)
-        #translate_counties(counties)
-        places = get_places(code)
-        update_places(states, counties, places)
+    # The national files are fetched once and their rows routed by state
+    codes = {'US-%s' % code.upper() for code in codes}
+    print(', '.join(sorted(codes)), file=sys.stderr)
+    with metrics.phase('get_counties') as phase:
+        counties = get_counties(list(codes))
+        phase['rows'] += len(counties)
+    with metrics.phase('update_counties') as phase:
+        counties = update_counties(codes, states, counties)
+        phase['rows'] += len(counties)
+    #translate_counties(counties)
+    with metrics.phase('get_places') as phase:
+        places = get_places(list(codes))
+        phase['rows'] += len(places)
+    with metrics.phase('update_places') as phase:
+        places = update_places(codes, states, counties, places)
+        phase['rows'] += len(places)
 
 def run():
     parser = ArgumentParser()
     parser.add_argument('-d', '--database', dest='database', required=True)
     parser.add_argument('-c', '--config', dest='config_file',
         help='the trytond config file')
+    parser.add_argument('--cache', dest='cache',
+        help='the directory caching the downloaded files')
+    parser.add_argument('--source', dest='source',
+        help='the directory of previously downloaded files to use offline')
+    parser.add_argument('--mirror', dest='mirror',
+        help='the base URL from which the files are downloaded by host '
+        'and path instead')
+    parser.add_argument('-l', '--loader', dest='loader', choices=LOADERS,
+        default='proteus',
+        help='how the records are saved: through proteus, with the trytond '
+        'ORM in the same process or with raw SQL inserts')
+    parser.add_argument('--metrics', dest='metrics_file', metavar='FILE',
+        help='write the duration, rows and calls of each phase and the '
+        'peak memory as JSON into FILE')
+    parser.add_argument('--trace-memory', dest='trace_memory',
+        action='store_true',
+        help='write the peak memory of each phase into the metrics, '
+        'which slows the import down')
+    parser.add_argument('--profile', dest='profile_file', metavar='FILE',
+        help='write the cProfile statistics into FILE')
     parser.add_argument('codes', nargs='+')
     if argcomplete:
         argcomplete.autocomplete(parser)
 
     args = parser.parse_args()
-    main(args.database, args.codes, args.config_file)
+    main(args.database, args.codes, args.config_file,
+        cache=args.cache, source=args.source, loader=args.loader,
+        mirror=args.mirror, metrics_file=args.metrics_file,
+        profile_file=args.profile_file, trace_memory=args.trace_memory)
 
 
 if __name__ == '__main__':
@@ -5,22 +5,35 @@ from __future__ import print_function
 
 import csv
 import datetime as dt
+from collections import Counter, namedtuple
+from contextlib import closing, contextmanager
 from decimal import Decimal
+from itertools import groupby, islice
+import json
+import multiprocessing
 import os
+import queue
+import shutil
 import sys
+import threading
+from tempfile import SpooledTemporaryFile
 
 
 try:
     from urllib.error import HTTPError
-    from urllib.request import urlopen
     from urllib.parse import urljoin
 except ImportError:
-    from urllib2 import urlopen, HTTPError
+    from urllib2 import HTTPError
 
 from html.parser import HTMLParser
 import zipfile
 from argparse import ArgumentParser
-from io import BytesIO, TextIOWrapper
+from io import TextIOWrapper
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 try:
     from progressbar import ETA, Bar, ProgressBar, SimpleProgress
@@ -33,6 +46,29 @@ except ImportError:
     prog = os.path.basename(sys.argv[0])
     sys.exit("proteus must be installed to use %s" % prog)
 
+try:
+    from .cache import Fetcher
+    from .loader import LOADERS, get_loader
+    from .metrics import Metrics, profile
+except ImportError:
+    from cache import Fetcher
+    from loader import LOADERS, get_loader
+    from metrics import Metrics, profile
+
+# Default number of CSV rows saved (and committed) per call
+CHUNK_SIZE = 1000
+# Size above which downloaded archives are spooled to disk
+SPOOL_SIZE = 8 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024
+# Number of chunks parsed ahead of the save by the pipelined import
+PIPELINE_SIZE = 2
+BASE_URL = 'https://www.streamlinedsalestax.org/ratesandboundry/Rates/'
+
+fetcher = Fetcher()
+loader = get_loader()
+metrics = Metrics()
+metrics.loader = loader
+
 class LinksExtractor(HTMLParser):
     def __init__(self):
         super().__init__()
@@ -47,6 +83,46 @@ class LinksExtractor(HTMLParser):
     def get_links(self):
         return self.links
 
+class Checkpoint(object):
+    "Last committed jurisdiction of each state, stored in a JSON file"
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.data = {}
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.data = json.load(f)
+
+    def get(self, code):
+        return self.data.get(code)
+
+    def set(self, code, code_fips):
+        self.data[code] = code_fips
+        self._write(code)
+
+    def done(self, code):
+        if self.data.pop(code, None) is not None:
+            self._write(code)
+
+    def _write(self, code):
+        if not self.filename:
+            return
+        # Other processes may update other states of the same file
+        with open(self.filename + '.lock', 'w') as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            data = {}
+            if os.path.exists(self.filename):
+                with open(self.filename) as f:
+                    data = json.load(f)
+            data.pop(code, None)
+            if code in self.data:
+                data[code] = self.data[code]
+            tmp = '%s.%s.tmp' % (self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.filename)
+
 def _progress(iterable):
     if ProgressBar:
         pbar = ProgressBar(
@@ -67,48 +143,238 @@ def _remove_forbidden_chars(name):
     from trytond.tools import remove_forbidden_chars
     return remove_forbidden_chars(name)
 
-def fetch(code):
-    sys.stderr.write('Fetching')
-    base = 'https://www.streamlinedsalestax.org/ratesandboundry/Rates/'
-    try:
-        responce = urlopen(base)
-    except HTTPError as e:
-        sys.exit("\nError fetching directory listing: %s" % e.reason)
-    parser = LinksExtractor()
-    parser.feed(TextIOWrapper(responce, encoding='utf-8').read())
-    parser.close()
-
-    files = {os.path.basename(a)[:2]: urljoin(base, a) for a in parser.get_links()}
-
+def _get_files():
+    "Return the URL of the rates file of each state code"
+    if not _files:
+        if fetcher.source:
+            links = [n for n in fetcher.listdir()
+                if n[2:3] == 'R'
+                and os.path.splitext(n)[1] in {'.zip', '.csv'}]
+        else:
+            try:
+                responce = fetcher.urlopen(BASE_URL)
+            except HTTPError as e:
+                sys.exit(
+                    "\nError fetching directory listing: %s" % e.reason)
+            parser = LinksExtractor()
+            with responce:
+                parser.feed(TextIOWrapper(responce, encoding='utf-8').read())
+            parser.close()
+            links = parser.get_links()
+        _files.update(
+            (os.path.basename(a)[:2], urljoin(BASE_URL, a)) for a in links)
+    return _files
+_files = {}
+
+def _get_url(code):
     try:
-        responce = urlopen(files[code])
+        return _get_files()[code]
     except KeyError:
         sys.exit("\nFile not found for code: %s" % code)
-    except HTTPError as e:
-        sys.exit("\nError downloading %s: %s" % (code, e.reason))
-    data = responce.read()
 
-    root, ext = os.path.splitext(responce.url)
+def download(code):
+    "Return the URL and the rates file of code spooled to a temporary file"
+    with metrics.phase('fetch', code):
+        url = _get_url(code)
+        try:
+            responce = fetcher.urlopen(url)
+        except HTTPError as e:
+            sys.exit("\nError downloading %s: %s" % (code, e.reason))
+        with responce:
+            spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            shutil.copyfileobj(responce, spool, BUFFER_SIZE)
+            url = responce.url
+    spool.seek(0)
+    return url, spool
+
+@contextmanager
+def _open_csv(url, f):
+    "Yield the CSV of the file f downloaded from url"
+    root, ext = os.path.splitext(url)
     if ext == '.zip':
-        with zipfile.ZipFile(BytesIO(data)) as zf:
-            data = zf.read(os.path.basename(root) + '.csv')
-    print('.', file=sys.stderr)
-    return data
+        with zipfile.ZipFile(f) as zf, \
+                zf.open(os.path.basename(root) + '.csv') as csv_file:
+            yield csv_file
+    else:
+        yield f
+
+@contextmanager
+def fetch_stream(code, downloaded=None):
+    """Yield the rates CSV of code as a binary stream
+
+    Zip archives are spooled to a temporary file (on disk once larger than
+    SPOOL_SIZE) and the CSV member is decompressed while it is read, so the
+    file is never held in memory as a whole. downloaded is the result of
+    download for code if it is already fetched."""
+    sys.stderr.write('Fetching')
+    if downloaded is not None:
+        url, spool = downloaded
+        print('.', file=sys.stderr)
+        with spool, _open_csv(url, spool) as f:
+            yield f
+        return
+    with metrics.phase('fetch', code):
+        url = _get_url(code)
+        try:
+            responce = fetcher.urlopen(url)
+        except HTTPError as e:
+            sys.exit("\nError downloading %s: %s" % (code, e.reason))
+    with responce:
+        if os.path.splitext(responce.url)[1] == '.zip':
+            with SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+                with metrics.phase('fetch', code):
+                    shutil.copyfileobj(responce, spool, BUFFER_SIZE)
+                spool.seek(0)
+                print('.', file=sys.stderr)
+                with _open_csv(responce.url, spool) as f:
+                    yield f
+        else:
+            print('.', file=sys.stderr)
+            yield responce
 
-def get_taxes(code):
-    Tax = Model.get('account.tax')
-    return {(t.name, t.start_date): t for t in Tax.find([
+def fetch(code):
+    with fetch_stream(code) as f:
+        return f.read()
+
+def read_rows(f):
+    "Yield a Row for each line of the binary CSV stream f"
+    for values in csv.reader(TextIOWrapper(f, encoding='utf-8')):
+        if not values:
+            continue
+        yield Row._make(values)
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _chunked_by_jurisdiction(rows, size):
+    "Yield chunks of at least size rows that never split a jurisdiction"
+    chunk = []
+    for row in rows:
+        if (len(chunk) >= size
+                and chunk[-1].jurisdiction_fips_code
+                != row.jurisdiction_fips_code):
+            yield chunk
+            chunk = []
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+def _threaded(iterable, size):
+    """Yield the items of iterable produced by a background thread
+
+    At most size items are produced ahead of the consumer. The exception
+    raised by the producer is raised in the consumer."""
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_end, e))
+        else:
+            put((_end, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+_end = object()
+
+def _skip_to(rows, code_fips):
+    """Yield the rows after those of the jurisdiction code_fips
+
+    A ValueError is raised when no row is of code_fips instead of skipping
+    all the rows."""
+    rows = iter(rows)
+    for row in rows:
+        if row.jurisdiction_fips_code == code_fips:
+            break
+    else:
+        raise ValueError(
+            "The checkpoint jurisdiction %s is not in the file" % code_fips)
+    for row in rows:
+        if row.jurisdiction_fips_code != code_fips:
+            yield row
+            break
+    yield from rows
+
+def _active(rows, as_of, stats=None):
+    """Yield the rows of the versions in effect at as_of or starting later
+
+    The expired versions and those superseded by a later version started at
+    as_of are counted as skipped in stats."""
+    as_of = as_of.strftime('%Y%m%d')
+    for _, versions in groupby(rows, key=lambda r: r.jurisdiction_fips_code):
+        versions = list(versions)
+        current = max((r.start_date for r in versions
+                if r.start_date <= as_of <= r.end_date), default=None)
+        for row in versions:
+            if (row.start_date > as_of
+                    or (current is not None and row.start_date == current)):
+                yield row
+            elif stats is not None:
+                stats['skipped'] += 1
+
+def get_taxes(code, names=None):
+    """Return the stored values of the taxes of code keyed by name and date
+
+    With names, only the taxes of those names are returned."""
+    domain = [
         ('authority', '!=', None),
         ('authority.subdivision.code', '=', code),
-        ])}
+        ]
+    if names is not None:
+        domain.append(('name', 'in', sorted(names)))
+    return {(t['name'], t['start_date']): t
+        for t in loader.search_read('account.tax', domain, _tax_fields)}
+
+def get_versions(code, codes_fips=None):
+    """Return the stored values of the versions of code keyed by FIPS and date
+
+    With codes_fips, only the versions of those jurisdictions are returned."""
+    domain = [
+        ('authority.subdivision.code', '=', code),
+        ]
+    if codes_fips is not None:
+        domain.append(('code_fips', 'in', sorted(codes_fips)))
+    return {(v['code_fips'], v['start_date']): v
+        for v in loader.search_read(
+            'account.tax.sstp.version', domain, _version_fields)}
 
 def get_places(code):
-    Place = Model.get('census.place')
-    return {p.code_fips: p for p in Place.find([('subdivision.code', '=', 'US-%s' % code)])}
+    return {p['code_fips']: p for p in loader.search_read('census.place', [
+                ('subdivision.code', '=', 'US-%s' % code),
+                ], ['code_fips', 'name'])}
 
 def get_groups():
     TaxGroup = Model.get('account.tax.group')
-    return {g.code: g for g in TaxGroup.find([])}
+    return TaxGroup.sstp_code2id(config.get_config().context)
 
 def get_company():
     Company = Model.get('company.company')
@@ -126,99 +392,341 @@ def get_tax_account(company=None):
         ('name', '=', 'Main Tax'),
         ], limit=1)
 
-def update_taxes(code, taxes):
+def _diff(values, stored, force=False):
+    "Return the values that differ from the stored ones"
+    if stored is None or force:
+        return values
+    return {k: v for k, v in values.items() if stored.get(k) != v}
+
+def _save_taxes(entries, taxes, stats, force=False, touched=None,
+        model='account.tax'):
+    """Create or write the (key, values) entries which differ from taxes
+
+    The saved values are stored into taxes and the jurisdictions of the saved
+    taxes are added to touched."""
+    to_create, to_write = [], []
+    for key, values in entries:
+        stored = taxes.get(key)
+        changes = _diff(values, stored, force=force)
+        if stored is None:
+            to_create.append((key, values))
+        elif changes:
+            to_write.append((key, changes))
+        else:
+            stats['unchanged'] += 1
+    if to_create:
+        ids = loader.create(model, [v for _, v in to_create])
+        for (key, values), id_ in zip(to_create, ids):
+            taxes[key] = dict(values, id=id_)
+        stats['inserted'] += len(to_create)
+    if to_write:
+        args = []
+        for key, changes in to_write:
+            args.extend([[taxes[key]['id']], changes])
+            taxes[key].update(changes)
+        loader.write(model, *args)
+        stats['updated'] += len(to_write)
+    if touched is not None:
+        touched.update(
+            taxes[k]['jurisdiction'] for k, _ in to_create + to_write
+            if taxes[k]['jurisdiction'] is not None)
+
+def refresh_rates(jurisdictions):
+    "Rebuild the combined rates of the jurisdictions"
+    if not jurisdictions:
+        return
+    Rate = Model.get('account.tax.sstp.rate')
+    Rate.refresh(sorted(jurisdictions), config.get_config().context)
+
+def preload():
+    "Return the records shared by the import of all the states"
+    company = get_company()
+    tax_account, = get_tax_account(company)
+    return {
+        'groups': get_groups(),
+        'tax_account': tax_account.id,
+        'rate_types': [t for t in _rate_types
+            if t in (company.sstp_rate_types or [])],
+        }
+
+@contextmanager
+def parse_chunks(f, code, batch_size, checkpoint, as_of=None, stats=None,
+        pipeline=False):
+    """Yield the chunks of the rows of code to import from the CSV stream f
+
+    The rows are resumed after the checkpoint of code and, with as_of,
+    filtered to the versions in effect at that date or later. With pipeline,
+    the chunks are parsed ahead by a thread."""
+    rows = metrics.iterate('parse', code, read_rows(f))
+    if checkpoint.get(code):
+        print("Resuming after %s" % checkpoint.get(code), file=sys.stderr)
+        rows = _skip_to(rows, checkpoint.get(code))
+    if as_of:
+        rows = _active(rows, as_of, stats)
+    chunks = _chunked_by_jurisdiction(rows, batch_size)
+    if pipeline:
+        chunks = _threaded(chunks, PIPELINE_SIZE)
+    with closing(chunks):
+        yield chunks
+
+def update_taxes(code, batch_size=None, checkpoint=None, force=False,
+        stats=None, shared=None, as_of=None, downloaded=None,
+        pipeline=False):
+    """Import the rates of code into versions and taxes
+
+    Each row is saved as a rate version and as taxes only for the rate types
+    enabled on the company. The stored versions and taxes are read for the
+    jurisdictions of each chunk only. The parent taxes of each chunk are saved
+    first so that their children are created or written with their parent
+    already set. The rates of the jurisdictions whose versions or taxes are
+    saved are refreshed before the checkpoint of each chunk is stored, so a
+    resumed import does not miss them. With as_of, only the versions in
+    effect at that date or later are imported. With pipeline, the next chunks
+    are parsed by a thread while the current one is saved."""
     TaxRule = Model.get('account.tax.rule')
-    Tax = Model.get('account.tax')
     print('Importing', file=sys.stderr)
 
-    places = get_places(code)
-    groups = get_groups()
-    tax_account, = get_tax_account()
+    if batch_size is None:
+        batch_size = CHUNK_SIZE
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+    if stats is None:
+        stats = Counter()
+    if shared is None:
+        shared = preload()
+    with metrics.phase('get_places', code) as phase:
+        places = get_places(code)
+        phase['rows'] += len(places)
+    groups = shared['groups']
+    tax_account = shared['tax_account']
+    rate_types = shared['rate_types']
 
-    f = TextIOWrapper(BytesIO(fetch(code)), encoding='utf-8')
-    records = []
     current_code_fips = None
-    for row in _progress(list(csv.DictReader(f, fieldnames=_fieldnames))):
-        authority = places[row['state']]
-        code_fips = row['jurisdiction_fips_code']
-        jurisdiction = places.get(row['jurisdiction_fips_code'])
-        start_date = dt.datetime.strptime(row['start_date'], '%Y%m%d').date()
-        end_date = dt.datetime.strptime(row['end_date'], '%Y%m%d').date()
-
-        for type_ in ['general_rate_intrastate', 'general_rate_interstate',
-            'food_rate_intrastate', 'food_rate_interstate']:
-            name = '%s %s' % (code_fips, type_)
-            description = '%s tax (%s)' % (code_fips
-                    if jurisdiction is None else jurisdiction.name, row[type_])
-
-            if current_code_fips != code_fips:
-                if (name, None) in taxes:
-                    parent = taxes[(name, None)]
-                else:
-                    parent = Tax(name=name)
-
-                parent.jurisdiction=jurisdiction
-                parent.description = description
-                parent.authority = authority
-                parent.type = 'none'
-                parent.group = groups[row['jurisdiction_type']]
-                records.append(parent)
-
-
-            if (name, start_date) in taxes:
-                record = taxes[(name, start_date)]
-            else:
-                record = Tax(name=name)
-
-            record.jurisdiction=jurisdiction
-            record.description = description
-            record.authority = authority
-            record.type = 'percentage'
-            record.group = groups[row['jurisdiction_type']]
-            record.rate = Decimal(row[type_])
-            record.start_date = start_date
-            record.end_date = None if end_date == dt.date.max else end_date
-
-            record.invoice_account = tax_account
-            record.credit_note_account = tax_account
-
-            records.append(record)
-        current_code_fips = code_fips
-
-    Tax.save(records)
-    return {(r.name, r.start_date): r for r in records}
-
-def update_taxes_parent(taxes):
-    print("Update taxes parent", file=sys.stderr)
-    Tax = Model.get('account.tax')
-
-    records = []
-    for k, record in _progress(taxes.items()):
-        name, start_date = k
-        if record.type == 'none':
-            continue
-        else:
-            record.parent = taxes[(name, None)]
-            records.append(record)
-    Tax.save(records)
-
+    with fetch_stream(code, downloaded) as f, \
+            parse_chunks(f, code, batch_size, checkpoint, as_of=as_of,
+                stats=stats, pipeline=pipeline) as chunks:
+        for rows in chunks:
+            parents, children, chunk_versions = [], [], []
+            jurisdictions = set()
+            with metrics.phase('build', code) as phase:
+                phase['rows'] += len(rows)
+                for row in rows:
+                    authority = places[row.state]
+                    code_fips = row.jurisdiction_fips_code
+                    jurisdiction = places.get(code_fips)
+                    start_date = dt.datetime.strptime(
+                        row.start_date, '%Y%m%d').date()
+                    end_date = dt.datetime.strptime(
+                        row.end_date, '%Y%m%d').date()
+                    group = groups[row.jurisdiction_type]
+                    if end_date == dt.date.max:
+                        end_date = None
+
+                    values = {
+                        'authority': authority['id'],
+                        'code_fips': code_fips,
+                        'jurisdiction': (
+                            jurisdiction['id'] if jurisdiction else None),
+                        'group': group,
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        }
+                    for type_ in _rate_types:
+                        values[type_] = Decimal(getattr(row, type_))
+                    chunk_versions.append(((code_fips, start_date), values))
+
+                    for type_ in rate_types:
+                        rate = getattr(row, type_)
+                        name = '%s %s' % (code_fips, type_)
+                        description = '%s tax' % (code_fips
+                            if jurisdiction is None
+                            else jurisdiction['name'])
+                        values = {
+                            'name': name,
+                            'jurisdiction': (
+                                jurisdiction['id'] if jurisdiction else None),
+                            'description': description,
+                            'authority': authority['id'],
+                            'group': group,
+                            }
+
+                        # The parent is shared by the versions so its
+                        # description does not depend on their rate
+                        if current_code_fips != code_fips:
+                            parents.append(
+                                ((name, None), dict(values, type='none')))
+                        children.append(((name, start_date), dict(values,
+                                    description='%s (%s)' % (
+                                        description, rate),
+                                    type='percentage',
+                                    rate=Decimal(rate),
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    invoice_account=tax_account,
+                                    credit_note_account=tax_account)))
+                    current_code_fips = code_fips
+
+            with metrics.phase('get_taxes', code) as phase:
+                taxes = {}
+                if children:
+                    taxes = get_taxes(
+                        'US-%s' % code, {n for (n, _), _ in children})
+                phase['rows'] += len(taxes)
+            with metrics.phase('get_versions', code) as phase:
+                versions = get_versions(
+                    'US-%s' % code, {c for (c, _), _ in chunk_versions})
+                phase['rows'] += len(versions)
+            with metrics.phase('save', code) as phase:
+                phase['rows'] += (
+                    len(chunk_versions) + len(parents) + len(children))
+                _save_taxes(chunk_versions, versions, stats, force=force,
+                    touched=jurisdictions, model='account.tax.sstp.version')
+                _save_taxes(parents, taxes, stats, force=force,
+                    touched=jurisdictions)
+                for (name, _), values in children:
+                    values['parent'] = taxes[(name, None)]['id']
+                _save_taxes(children, taxes, stats, force=force,
+                    touched=jurisdictions)
+            with metrics.phase('refresh', code) as phase:
+                refresh_rates(jurisdictions)
+                phase['rows'] += len(jurisdictions)
+            checkpoint.set(code, current_code_fips)
+            sys.stderr.write('.')
+    print('', file=sys.stderr)
+
+_tax_fields = ['name', 'description', 'type', 'authority', 'jurisdiction',
+    'group', 'rate', 'start_date', 'end_date', 'invoice_account',
+    'credit_note_account', 'parent']
+_version_fields = ['authority', 'code_fips', 'jurisdiction', 'group',
+    'start_date', 'end_date', 'general_rate_intrastate',
+    'general_rate_interstate', 'food_rate_intrastate', 'food_rate_interstate']
 _fieldnames = ['state', 'jurisdiction_type', 'jurisdiction_fips_code',
     'general_rate_intrastate', 'general_rate_interstate',
     'food_rate_intrastate', 'food_rate_interstate', 'start_date', 'end_date']
+_rate_types = ['general_rate_intrastate', 'general_rate_interstate',
+    'food_rate_intrastate', 'food_rate_interstate']
+Row = namedtuple('Row', _fieldnames)
 
 
-def main(database, codes, config_file=None):
-    config.set_trytond(database, config_file=config_file)
-    do_import(codes)
+def set_loader(name):
+    global loader
+    loader = get_loader(name)
+    metrics.loader = loader
 
 
-def do_import(codes):
+def main(database, codes, config_file=None, batch_size=None,
+        checkpoint=None, force=False, jobs=1, cache=None, source=None,
+        loader='proteus', mirror=None, metrics_file=None, profile_file=None,
+        active=False, as_of=None, prefetch=0, trace_memory=False):
+    config.set_trytond(database, config_file=config_file)
+    metrics.install(config.get_config(), trace_memory=trace_memory)
+    fetcher.cache, fetcher.source, fetcher.mirror = cache, source, mirror
+    set_loader(loader)
+    if active and as_of is None:
+        as_of = dt.date.today()
+    try:
+        with profile(profile_file):
+            do_import(codes, batch_size=batch_size, checkpoint=checkpoint,
+                force=force, jobs=jobs, profile_file=profile_file,
+                as_of=as_of, prefetch=prefetch)
+    finally:
+        if metrics_file:
+            metrics.dump(metrics_file, script='import_rates',
+                codes=[c.upper() for c in codes], loader=loader, jobs=jobs)
+
+
+def do_import(codes, batch_size=None, checkpoint=None, force=False, jobs=1,
+        profile_file=None, as_of=None, prefetch=0):
+    """Import the rates of codes
+
+    With prefetch, the files of the next states are downloaded by a thread
+    while a state is imported, at most prefetch ahead, and the rows are
+    parsed ahead of their save."""
+    codes = [c.upper() for c in codes]
+    with metrics.phase('preload'):
+        shared = preload()
+    options = {
+        'batch_size': batch_size,
+        'checkpoint': checkpoint,
+        'force': force,
+        'shared': shared,
+        'as_of': as_of,
+        'pipeline': bool(prefetch),
+        }
+    if jobs > 1 and len(codes) > 1:
+        return _do_import_parallel(codes, jobs, options, profile_file)
+    if prefetch:
+        downloads = _threaded(((c, download(c)) for c in codes), prefetch)
+        with closing(downloads):
+            for code, downloaded in downloads:
+                import_state(code, downloaded=downloaded, **options)
+        return
     for code in codes:
-        print(code, file=sys.stderr)
-        code = code.upper()
-        taxes = get_taxes('US-%s' % code)
-        taxes = update_taxes(code, taxes)
-        update_taxes_parent(taxes)
+        import_state(code, **options)
+
+
+def import_state(code, batch_size=None, checkpoint=None, force=False,
+        shared=None, as_of=None, downloaded=None, pipeline=False):
+    print(code, file=sys.stderr)
+    checkpoint = Checkpoint(checkpoint)
+    stats = Counter()
+    update_taxes(code, batch_size=batch_size,
+        checkpoint=checkpoint, force=force, stats=stats, shared=shared,
+        as_of=as_of, downloaded=downloaded, pipeline=pipeline)
+    checkpoint.done(code)
+    print("%s: %d inserted, %d updated, %d unchanged, %d skipped" % (
+            code, stats['inserted'], stats['updated'],
+            stats['unchanged'], stats['skipped']), file=sys.stderr)
+    return stats
+
+
+def _do_import_parallel(codes, jobs, options, profile_file=None):
+    current = config.get_config()
+    # Spawn fresh workers instead of forking the open database connections
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(jobs, len(codes)), initializer=_init_worker,
+            initargs=(current.database, current.config_file, fetcher,
+                loader, options, profile_file, metrics.tracing)) as pool:
+        errors = {}
+        for code, error, phases in pool.imap_unordered(
+                _import_worker, codes):
+            metrics.merge(phases)
+            if error:
+                print("%s: failed: %s" % (code, error), file=sys.stderr)
+                errors[code] = error
+    if errors:
+        sys.exit("Failed to import: %s" % ', '.join(sorted(errors)))
+
+
+_worker_options = None
+_worker_profile_file = None
+
+
+def _init_worker(database, config_file, fetcher_, loader_, options,
+        profile_file=None, trace_memory=False):
+    global _worker_options, _worker_profile_file, loader
+    config.set_trytond(database, config_file=config_file)
+    metrics.install(config.get_config(), trace_memory=trace_memory)
+    fetcher.cache, fetcher.source, fetcher.mirror = (
+        fetcher_.cache, fetcher_.source, fetcher_.mirror)
+    loader = metrics.loader = loader_
+    _worker_options = options
+    _worker_profile_file = profile_file
+
+
+def _import_worker(code):
+    "Import code and return the error and the metrics of its phases"
+    error = None
+    profile_file = None
+    if _worker_profile_file:
+        profile_file = '%s.%s' % (_worker_profile_file, code)
+    try:
+        with profile(profile_file):
+            import_state(code, **_worker_options)
+    except (Exception, SystemExit) as e:
+        error = str(e).strip() or repr(e)
+    phases = [p for p in metrics.to_dict() if p['state'] == code]
+    return code, error, phases
 
 
 def run():
@@ -227,11 +735,56 @@ def run():
     parser.add_argument('-c', '--config', dest='config_file',
         help='the trytond config file')
     parser.add_argument('-a', '--active', action='store_true',
-        help='only import active taxes')
+        help='only import the rate versions in effect today or later')
+    parser.add_argument('--as-of', dest='as_of', metavar='DATE',
+        type=dt.date.fromisoformat,
+        help='only import the rate versions in effect at DATE (YYYY-MM-DD) '
+        'or later')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+        default=CHUNK_SIZE,
+        help='the number of rows saved and committed at once')
+    parser.add_argument('--checkpoint', dest='checkpoint',
+        help='the file storing the last committed jurisdiction '
+        'to resume an interrupted import')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='write all taxes even if they did not change')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+        help='the number of states imported concurrently')
+    parser.add_argument('-p', '--prefetch', dest='prefetch', type=int,
+        default=0, metavar='N',
+        help='download the files of up to N next states while a state is '
+        'imported and parse its rows ahead of their save')
+    parser.add_argument('--cache', dest='cache',
+        help='the directory caching the downloaded files')
+    parser.add_argument('--source', dest='source',
+        help='the directory of previously downloaded files to use offline')
+    parser.add_argument('--mirror', dest='mirror',
+        help='the base URL from which the files are downloaded by host '
+        'and path instead')
+    parser.add_argument('-l', '--loader', dest='loader', choices=LOADERS,
+        default='proteus',
+        help='how the records are saved: through proteus, with the trytond '
+        'ORM in the same process or with raw SQL inserts')
+    parser.add_argument('--metrics', dest='metrics_file', metavar='FILE',
+        help='write the duration, rows and calls of each phase and state '
+        'and the peak memory as JSON into FILE')
+    parser.add_argument('--trace-memory', dest='trace_memory',
+        action='store_true',
+        help='write the peak memory of each phase into the metrics, '
+        'which slows the import down')
+    parser.add_argument('--profile', dest='profile_file', metavar='FILE',
+        help='write the cProfile statistics into FILE '
+        '(FILE.<code> for each state imported by a job)')
     parser.add_argument('codes', nargs='+')
 
     args = parser.parse_args()
-    main(args.database, args.codes, args.config_file)
+    main(args.database, args.codes, args.config_file,
+        batch_size=args.batch_size, checkpoint=args.checkpoint,
+        force=args.force, jobs=args.jobs, cache=args.cache,
+        source=args.source, loader=args.loader, mirror=args.mirror,
+        metrics_file=args.metrics_file, profile_file=args.profile_file,
+        active=args.active, as_of=args.as_of, prefetch=args.prefetch,
+        trace_memory=args.trace_memory)
 
 
 if __name__ == '__main__':
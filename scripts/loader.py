@@ -0,0 +1,160 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from contextlib import contextmanager
+from itertools import islice, repeat
+
+from proteus import Model, config
+
+LOADERS = ['proteus', 'trytond', 'sql']
+# Number of rows per INSERT of the sql loader
+INSERT_SIZE = 1000
+
+
+def get_loader(name='proteus'):
+    return {
+        'proteus': ProteusLoader,
+        'trytond': TrytondLoader,
+        'sql': SQLLoader,
+        }[name]()
+
+
+class ProteusLoader(object):
+    "Load plain values through the proteus proxy of the models"
+
+    def __init__(self):
+        # Number of calls made to the loader
+        self.calls = 0
+
+    def search_read(self, model, domain, fields_names):
+        self.calls += 1
+        proxy = Model.get(model)._proxy
+        return proxy.search_read(
+            domain, 0, None, None, fields_names, config.get_config().context)
+
+    def create(self, model, vlist):
+        "Create the records of vlist and return their ids"
+        self.calls += 1
+        proxy = Model.get(model)._proxy
+        return proxy.create(vlist, config.get_config().context)
+
+    def write(self, model, *args):
+        "Write alternating lists of ids and values"
+        self.calls += 1
+        proxy = Model.get(model)._proxy
+        proxy.write(*args, config.get_config().context)
+
+    def delete(self, model, ids):
+        self.calls += 1
+        proxy = Model.get(model)._proxy
+        proxy.delete(ids, config.get_config().context)
+
+
+class TrytondLoader(ProteusLoader):
+    """Load plain values with the ModelSQL methods inside a trytond
+    transaction, without the RPC conversion and the proteus records
+
+    Each call runs in its own transaction which is committed at the end."""
+
+    @contextmanager
+    def transaction(self, readonly=False):
+        from trytond.transaction import Transaction
+        current = config.get_config()
+        if not hasattr(current, 'pool'):
+            raise ValueError("The %s loader requires a trytond configuration"
+                % self.__class__.__name__)
+        with Transaction().start(current.database_name, current.user,
+                readonly=readonly, context=current.context):
+            yield current.pool
+
+    def search_read(self, model, domain, fields_names):
+        self.calls += 1
+        with self.transaction(readonly=True) as pool:
+            return pool.get(model).search_read(
+                domain, fields_names=fields_names)
+
+    def create(self, model, vlist):
+        self.calls += 1
+        with self.transaction() as pool:
+            return [r.id for r in pool.get(model).create(vlist)]
+
+    def write(self, model, *args):
+        self.calls += 1
+        with self.transaction() as pool:
+            Model_ = pool.get(model)
+            actions = iter(args)
+            args = []
+            for ids, values in zip(actions, actions):
+                args.extend([Model_.browse(ids), values])
+            Model_.write(*args)
+
+    def delete(self, model, ids):
+        self.calls += 1
+        with self.transaction() as pool:
+            Model_ = pool.get(model)
+            Model_.delete(Model_.browse(ids))
+
+
+class SQLLoader(TrytondLoader):
+    """Create records with raw multi-row INSERT statements
+
+    The default values are filled like the ORM does but neither the access
+    rights nor the constraints are checked, so it must only be used with
+    trusted data. The paths of the trees are set in bulk after the inserts
+    and the _after_sql_insert method of the model, if any, is called with the
+    ids to clear its caches. It falls back to the ORM when the database can
+    not return the inserted ids."""
+
+    def create(self, model, vlist):
+        from sql import Column
+        from sql.functions import CurrentTimestamp
+
+        from trytond.model import fields
+        from trytond.transaction import Transaction
+
+        self.calls += 1
+        with self.transaction() as pool:
+            Model_ = pool.get(model)
+            transaction = Transaction()
+            if (not transaction.database.has_returning()
+                    or Model_._mptt_fields):
+                return [r.id for r in Model_.create(vlist)]
+            table = Model_.__table__()
+            cursor = transaction.connection.cursor()
+
+            names = set()
+            for values in vlist:
+                names.update(values)
+            defaults = Model_._clean_defaults(Model_.default_get(
+                    [n for n, f in Model_._fields.items()
+                        if n not in names
+                        and n not in {
+                            'id', 'create_uid', 'create_date',
+                            'write_uid', 'write_date'}
+                        and not isinstance(f, fields.Function)],
+                    with_rec_name=False))
+            names = sorted(
+                n for n in names | set(defaults)
+                if not hasattr(Model_._fields[n], 'set'))
+            columns = [table.create_uid, table.create_date] + [
+                Column(table, n) for n in names]
+
+            ids = []
+            rows = iter(vlist)
+            while True:
+                chunk = list(islice(rows, INSERT_SIZE))
+                if not chunk:
+                    break
+                cursor.execute(*table.insert(columns, [
+                            [transaction.user, CurrentTimestamp()]
+                            + [Model_._fields[n].sql_format(
+                                    v.get(n, defaults.get(n)))
+                                for n in names]
+                            for v in chunk],
+                        [table.id]))
+                ids.extend(r[0] for r in cursor)
+            if Model_._path_fields:
+                field_names = sorted(Model_._path_fields)
+                Model_._set_path(field_names, repeat(ids, len(field_names)))
+            if hasattr(Model_, '_after_sql_insert'):
+                Model_._after_sql_insert(ids)
+            return ids
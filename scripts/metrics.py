@@ -0,0 +1,197 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import cProfile
+import datetime as dt
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+FIELDS = ['wall_s', 'rows', 'rpc_calls', 'loader_calls', 'peak_mem']
+
+
+def peak_rss(children=False):
+    """Return the peak resident memory of the process in KiB
+
+    With children, it is the largest peak of the terminated child
+    processes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children
+        else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class Metrics(object):
+    """Record the wall time, rows and calls of the phases
+
+    A phase is accumulated per name and state. The RPC calls are the calls
+    made through the proxies of the proteus configuration and the loader
+    calls those made to the loader. When the memory is traced, peak_mem is
+    the peak in bytes of the Python memory allocated during the phase,
+    otherwise it stays 0. The resident memory is only known for the whole
+    process, so it is written with the totals."""
+
+    def __init__(self):
+        self.phases = {}
+        # Values of the phases being run to which the traced peak belongs
+        self._running = []
+        self.rpc_calls = 0
+        self.loader = None
+        self.started = dt.datetime.now()
+        self._start = time.perf_counter()
+
+    def install(self, config, trace_memory=False):
+        """Count the calls made through the proxies of config
+
+        With trace_memory, the peak memory of each phase is traced."""
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        get_proxy = config.get_proxy
+
+        def counting_proxy(*args, **kwargs):
+            return _CountingProxy(get_proxy(*args, **kwargs), self)
+        config.get_proxy = counting_proxy
+
+    def _snapshot(self):
+        return (time.perf_counter(), self.rpc_calls,
+            self.loader.calls if self.loader else 0)
+
+    def get(self, name, state=None):
+        "Return the accumulated values of the phase"
+        key = (state, name)
+        if key not in self.phases:
+            self.phases[key] = dict.fromkeys(FIELDS, 0)
+        return self.phases[key]
+
+    @contextmanager
+    def phase(self, name, state=None):
+        """Accumulate the duration and calls of the block into the phase
+
+        The values of the phase are yielded so the rows can be added. The
+        block of a nested phase is accounted in both phases."""
+        values = self.get(name, state)
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # The peak is global so it is given to the running phases first
+            self._update_peak()
+            tracemalloc.reset_peak()
+            self._running.append(values)
+        start = self._snapshot()
+        try:
+            yield values
+        finally:
+            end = self._snapshot()
+            values['wall_s'] += end[0] - start[0]
+            values['rpc_calls'] += end[1] - start[1]
+            values['loader_calls'] += end[2] - start[2]
+            if tracing:
+                self._update_peak()
+                # By identity as the values of distinct phases may be equal
+                for i in reversed(range(len(self._running))):
+                    if self._running[i] is values:
+                        del self._running[i]
+                        break
+
+    def _update_peak(self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for values in self._running:
+            values['peak_mem'] = max(values['peak_mem'], peak)
+
+    @property
+    def tracing(self):
+        "Whether the peak memory of the phases is traced"
+        return tracemalloc.is_tracing()
+
+    def iterate(self, name, state, iterable):
+        "Yield the items of iterable accounting each one as a row of phase"
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name, state) as values:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                values['rows'] += 1
+            yield item
+
+    def merge(self, phases):
+        """Add the phases returned by to_dict of another process
+
+        The peak memory is the largest of both."""
+        for phase in phases:
+            values = self.get(phase['phase'], phase['state'])
+            for field in FIELDS:
+                if field == 'peak_mem':
+                    values[field] = max(values[field], phase[field])
+                else:
+                    values[field] += phase[field]
+
+    def to_dict(self):
+        phases = []
+        for (state, name), values in self.phases.items():
+            wall = values['wall_s']
+            phases.append(dict(values, state=state, phase=name,
+                    rows_per_s=(
+                        values['rows'] / wall if wall and values['rows']
+                        else None)))
+        return phases
+
+    def dump(self, filename, **extra):
+        "Write the phases and the totals as JSON into filename"
+        result = dict(extra,
+            started=self.started.isoformat(),
+            wall_s=time.perf_counter() - self._start,
+            peak_rss_kib=peak_rss(),
+            children_peak_rss_kib=peak_rss(children=True),
+            phases=self.to_dict())
+        with open(filename, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+class _CountingProxy(object):
+
+    def __init__(self, proxy, metrics):
+        self._proxy = proxy
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        method = getattr(self._proxy, name)
+        if name.startswith('_'):
+            return method
+        return _CountingMethod(method, self._metrics)
+
+
+class _CountingMethod(object):
+    # Not a function so it is not bound when set on a class
+
+    def __init__(self, method, metrics):
+        self._method = method
+        self._metrics = metrics
+
+    def __call__(self, *args, **kwargs):
+        self._metrics.rpc_calls += 1
+        return self._method(*args, **kwargs)
+
+
+@contextmanager
+def profile(filename):
+    "Profile the block into filename if it is set"
+    if not filename:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(filename)
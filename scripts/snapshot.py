@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import datetime as dt
+import gzip
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from decimal import Decimal
+
+try:
+    from proteus import Model, config
+except ImportError:
+    prog = os.path.basename(sys.argv[0])
+    sys.exit("proteus must be installed to use %s" % prog)
+
+try:
+    from .import_rates import get_company, get_tax_account
+    from .loader import LOADERS, get_loader
+except ImportError:
+    from import_rates import get_company, get_tax_account
+    from loader import LOADERS, get_loader
+
+# Version of the snapshot file
+FORMAT = 2
+# Default number of records created (and committed) per call
+CHUNK_SIZE = 5000
+
+loader = get_loader()
+
+RATE_TYPES = ['general_rate_intrastate', 'general_rate_interstate',
+    'food_rate_intrastate', 'food_rate_interstate']
+
+_place_fields = ['country.code', 'subdivision.code', 'name', 'code_gnis',
+    'code_fips', 'class_code.code', 'region.code', 'level', 'active']
+_tax_fields = ['name', 'description', 'type', 'group', 'rate',
+    'start_date', 'end_date']
+_version_fields = ['code_fips', 'group', 'start_date', 'end_date',
+    'general_rate_intrastate', 'general_rate_interstate',
+    'food_rate_intrastate', 'food_rate_interstate']
+
+def _depth(place):
+    return place['path'].count('/')
+
+def _get(values, name):
+    "Return the value of the dotted name from the search_read values"
+    if '.' in name:
+        related, name = name.split('.', 1)
+        return (values.get(related + '.') or {}).get(name)
+    return values[name]
+
+def _dumps(value):
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(repr(value))
+
+def export_places():
+    "Return the places as rows ordered with the parents first"
+    places = loader.search_read('census.place', [],
+        ['id', 'parent', 'path'] + _place_fields)
+    places.sort(key=lambda p: (_depth(p), p['id']))
+    return [[p['id'], p['parent']] + [_get(p, f) for f in _place_fields]
+        for p in places]
+
+def export_counties():
+    "Return the other counties of the places as rows"
+    return [[p['id'], c] for p in loader.search_read('census.place', [
+                ('counties', '!=', None),
+                ], ['id', 'counties'])
+        for c in p['counties']]
+
+def export_taxes():
+    "Return the SSTP taxes as rows ordered with the parents first"
+    TaxGroup = Model.get('account.tax.group')
+    id2group = {i: c for c, i in TaxGroup.sstp_code2id(
+            config.get_config().context).items()}
+    taxes = loader.search_read('account.tax', [
+            ('authority', '!=', None),
+            ], ['id', 'parent', 'authority', 'jurisdiction'] + _tax_fields)
+    taxes.sort(key=lambda t: (t['parent'] is not None, t['id']))
+    rows = []
+    for tax in taxes:
+        tax['group'] = id2group.get(tax['group'])
+        rows.append([tax['id'], tax['parent'], tax['authority'],
+                tax['jurisdiction']] + [tax[f] for f in _tax_fields])
+    return rows
+
+def export_versions():
+    "Return the SSTP rate versions as rows"
+    TaxGroup = Model.get('account.tax.group')
+    id2group = {i: c for c, i in TaxGroup.sstp_code2id(
+            config.get_config().context).items()}
+    versions = loader.search_read('account.tax.sstp.version', [],
+        ['authority', 'jurisdiction'] + _version_fields)
+    rows = []
+    for version in versions:
+        version['group'] = id2group.get(version['group'])
+        rows.append([version['authority'], version['jurisdiction']]
+            + [version[f] for f in _version_fields])
+    return rows
+
+def export(filename):
+    "Write the places, the SSTP versions and taxes into the filename"
+    print('Exporting', file=sys.stderr)
+    data = {
+        'format': FORMAT,
+        'places': {
+            'fields': ['id', 'parent'] + _place_fields,
+            'rows': export_places(),
+            },
+        'counties': {
+            'fields': ['place', 'county'],
+            'rows': export_counties(),
+            },
+        'taxes': {
+            'fields': ['id', 'parent', 'authority', 'jurisdiction']
+            + _tax_fields,
+            'rows': export_taxes(),
+            },
+        'versions': {
+            'fields': ['authority', 'jurisdiction'] + _version_fields,
+            'rows': export_versions(),
+            },
+        }
+    with gzip.open(filename, 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'), default=_dumps)
+    print("%d places, %d versions and %d taxes exported" % (
+            len(data['places']['rows']), len(data['versions']['rows']),
+            len(data['taxes']['rows'])), file=sys.stderr)
+
+def _code2id(model, codes):
+    return {r['code']: r['id'] for r in loader.search_read(model, [
+                ('code', 'in', sorted(c for c in codes if c)),
+                ], ['code'])}
+
+def _restore(model, rows, existing, key, get_values, batch_size):
+    """Create the values of the rows whose key is missing from existing
+
+    The rows must be ordered with the parents first, they are created by
+    batches which never contain both a parent and one of its children. It
+    returns the new ids keyed by the old ones."""
+    ids = {}
+    keys, vlist = [], []
+
+    def flush():
+        ids.update(zip(keys, loader.create(model, vlist)))
+        del keys[:], vlist[:]
+        sys.stderr.write('.')
+
+    for row in rows:
+        # The parent is not created yet
+        if row['parent'] is not None and row['parent'] not in ids and vlist:
+            flush()
+        values = get_values(row, ids.get(row['parent']))
+        if key(values) in existing:
+            ids[row['id']] = existing[key(values)]
+            continue
+        keys.append(row['id'])
+        vlist.append(values)
+        if len(vlist) >= batch_size:
+            flush()
+    if vlist:
+        flush()
+    return ids
+
+def restore_places(rows, batch_size):
+    """Create the missing places of rows and return the new ids of the old
+
+    The places are matched by country, subdivision and FIPS code."""
+    Region = Model.get('census.region')
+    ClassCode = Model.get('census.class_code')
+    context = config.get_config().context
+    rows = [dict(zip(['id', 'parent'] + _place_fields, r)) for r in rows]
+    countries = _code2id(
+        'country.country', {r['country.code'] for r in rows})
+    subdivisions = _code2id(
+        'country.subdivision', {r['subdivision.code'] for r in rows})
+    regions = Region.code2id(context)
+    class_codes = ClassCode.code2id(context)
+
+    def key(values):
+        return (values['country'], values['subdivision'], values['code_fips'])
+    existing = {key(p): p['id'] for p in loader.search_read('census.place',
+            [], ['country', 'subdivision', 'code_fips'])}
+
+    def get_values(row, parent):
+        if row['country.code'] not in countries:
+            sys.exit("Error missing country with code %s"
+                % row['country.code'])
+        return {
+            'country': countries[row['country.code']],
+            'subdivision': subdivisions.get(row['subdivision.code']),
+            'name': row['name'],
+            'code_gnis': row['code_gnis'],
+            'code_fips': row['code_fips'],
+            'class_code': class_codes.get(row['class_code.code']),
+            'region': regions.get(row['region.code']),
+            'level': row['level'],
+            'active': row['active'],
+            'parent': parent,
+            }
+    return _restore(
+        'census.place', rows, existing, key, get_values, batch_size)
+
+def restore_counties(rows, places, batch_size):
+    "Add the other counties of rows to the places remapped"
+    counties = {}
+    for place, county in rows:
+        counties.setdefault(places[place], []).append(places[county])
+    args = [[[p], {'counties': [('add', c)]}]
+        for p, c in sorted(counties.items())]
+    for i in range(0, len(args), batch_size):
+        loader.write('census.place',
+            *(a for arg in args[i:i + batch_size] for a in arg))
+        sys.stderr.write('.')
+
+def restore_taxes(rows, places, batch_size):
+    """Create the missing SSTP taxes of rows with the places remapped
+
+    Only the taxes of the rate types enabled on the company are restored.
+    The taxes are matched by authority, name and start date. It returns the
+    ids of the authorities."""
+    TaxGroup = Model.get('account.tax.group')
+    groups = TaxGroup.sstp_code2id(config.get_config().context)
+    company = get_company()
+    tax_account, = get_tax_account(company)
+    rate_types = set(company.sstp_rate_types or [])
+    rows = [dict(zip(['id', 'parent', 'authority', 'jurisdiction']
+                + _tax_fields, r)) for r in rows]
+    rows = [r for r in rows if r['name'].partition(' ')[2] in rate_types]
+
+    def key(values):
+        return (values['authority'], values['name'], values['start_date'])
+    existing = {key(t): t['id'] for t in loader.search_read('account.tax', [
+                ('authority', '!=', None),
+                ], ['authority', 'name', 'start_date'])}
+
+    def get_values(row, parent):
+        values = {f: row[f] for f in _tax_fields}
+        values.update({
+                'authority': places[row['authority']],
+                'jurisdiction': places.get(row['jurisdiction']),
+                'group': groups.get(row['group']),
+                'parent': parent,
+                })
+        if row['rate'] is not None:
+            values['rate'] = Decimal(row['rate'])
+        for name in ['start_date', 'end_date']:
+            if row[name]:
+                values[name] = dt.date.fromisoformat(row[name])
+        if row['type'] == 'percentage':
+            values['invoice_account'] = tax_account.id
+            values['credit_note_account'] = tax_account.id
+        return values
+    _restore('account.tax', rows, existing, key, get_values, batch_size)
+    return {places[r['authority']] for r in rows}
+
+def restore_versions(rows, places, batch_size):
+    """Create the missing SSTP rate versions of rows with the places remapped
+
+    The versions are matched by authority, FIPS code and start date. It
+    returns the ids of the authorities."""
+    TaxGroup = Model.get('account.tax.group')
+    groups = TaxGroup.sstp_code2id(config.get_config().context)
+    rows = [dict(zip(['authority', 'jurisdiction'] + _version_fields, r),
+            id=i, parent=None) for i, r in enumerate(rows)]
+
+    def key(values):
+        return (values['authority'], values['code_fips'],
+            values['start_date'])
+    existing = {key(v): v['id'] for v in loader.search_read(
+            'account.tax.sstp.version', [],
+            ['authority', 'code_fips', 'start_date'])}
+
+    def get_values(row, parent):
+        values = {f: row[f] for f in _version_fields}
+        values.update({
+                'authority': places[row['authority']],
+                'jurisdiction': places.get(row['jurisdiction']),
+                'group': groups.get(row['group']),
+                })
+        for name in RATE_TYPES:
+            values[name] = Decimal(row[name])
+        for name in ['start_date', 'end_date']:
+            if row[name]:
+                values[name] = dt.date.fromisoformat(row[name])
+        return values
+    _restore('account.tax.sstp.version', rows, existing, key, get_values,
+        batch_size)
+    return {places[r['authority']] for r in rows}
+
+def _versions_from_taxes(rows):
+    """Return the SSTP rate version rows of the tax rows of the first format
+
+    The rates of the child taxes are grouped by authority, FIPS code and
+    start date, the versions missing a rate type are skipped."""
+    versions = {}
+    for row in rows:
+        tax = dict(zip(['id', 'parent', 'authority', 'jurisdiction']
+                + _tax_fields, row))
+        if tax['type'] != 'percentage' or not tax['start_date']:
+            continue
+        code_fips, rate_type = tax['name'].split(' ', 1)
+        if rate_type not in RATE_TYPES:
+            continue
+        key = (tax['authority'], code_fips, tax['start_date'])
+        version = versions.setdefault(key, {
+                'authority': tax['authority'],
+                'jurisdiction': tax['jurisdiction'],
+                'code_fips': code_fips,
+                'group': tax['group'],
+                'start_date': tax['start_date'],
+                'end_date': tax['end_date'],
+                })
+        version[rate_type] = tax['rate']
+    return [[v['authority'], v['jurisdiction']]
+        + [v[f] for f in _version_fields]
+        for v in versions.values() if all(t in v for t in RATE_TYPES)]
+
+def restore(filename, batch_size=None):
+    "Load the places, the SSTP versions and taxes of the snapshot filename"
+    if batch_size is None:
+        batch_size = CHUNK_SIZE
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        data = json.load(f)
+    if data.get('format') not in {1, FORMAT}:
+        sys.exit("Error unsupported snapshot format: %s"
+            % data.get('format'))
+    if data['format'] == 1:
+        data['versions'] = {
+            'rows': _versions_from_taxes(data['taxes']['rows']),
+            }
+    sys.stderr.write('Restoring places')
+    places = restore_places(data['places']['rows'], batch_size)
+    # The snapshots written before the other counties have none
+    if 'counties' in data:
+        restore_counties(data['counties']['rows'], places, batch_size)
+    print('', file=sys.stderr)
+    sys.stderr.write('Restoring versions')
+    authorities = restore_versions(
+        data['versions']['rows'], places, batch_size)
+    print('', file=sys.stderr)
+    sys.stderr.write('Restoring taxes')
+    authorities |= restore_taxes(data['taxes']['rows'], places, batch_size)
+    print('', file=sys.stderr)
+    if authorities:
+        print('Refreshing rates', file=sys.stderr)
+        Rate = Model.get('account.tax.sstp.rate')
+        Rate.refresh(sorted(authorities), config.get_config().context)
+
+def set_loader(name):
+    global loader
+    loader = get_loader(name)
+
+def main(database, action, filename, config_file=None, batch_size=None,
+        loader='proteus'):
+    config.set_trytond(database, config_file=config_file)
+    set_loader(loader)
+    with config.get_config().set_context(active_test=False):
+        if action == 'export':
+            export(filename)
+        else:
+            restore(filename, batch_size=batch_size)
+
+def run():
+    parser = ArgumentParser(
+        description="Export or restore the census places and SSTP taxes")
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('-c', '--config', dest='config_file',
+        help='the trytond config file')
+    parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+        default=CHUNK_SIZE,
+        help='the number of records restored and committed at once')
+    parser.add_argument('-l', '--loader', dest='loader', choices=LOADERS,
+        default='proteus',
+        help='how the records are read and saved: through proteus, with the '
+        'trytond ORM in the same process or with raw SQL inserts')
+    parser.add_argument('action', choices=['export', 'restore'])
+    parser.add_argument('filename')
+
+    args = parser.parse_args()
+    main(args.database, args.action, args.filename, args.config_file,
+        batch_size=args.batch_size, loader=args.loader)
+
+if __name__ == '__main__':
+    run()
@@ -1,14 +1,73 @@
+import datetime as dt
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import groupby
+
+from sql import Column, Null
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import (
-        DeactivableMixin, MatchMixin, ModelSQL, ModelView, fields,
-        sequence_ordered, tree)
+        DeactivableMixin, Index, MatchMixin, ModelSQL, ModelView, Unique,
+        fields, sequence_ordered, tree)
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
+RATE_TYPES = ['general_rate_intrastate', 'general_rate_interstate',
+    'food_rate_intrastate', 'food_rate_interstate']
+
+
+class TaxGroup(metaclass=PoolMeta):
+    __name__ = 'account.tax.group'
+    _sstp_code2id_cache = Cache(__name__ + '.sstp_code2id', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.__rpc__.update({
+                'sstp_code2id': RPC(),
+                })
+
+    @classmethod
+    def sstp_code2id(cls):
+        "Return a dictionary mapping the SSTP jurisdiction types to the ids"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        code2id = cls._sstp_code2id_cache.get(None)
+        if code2id is None:
+            data = ModelData.search([
+                    ('module', '=', 'account_us_sstp'),
+                    ('model', '=', cls.__name__),
+                    ])
+            code2id = {g.code: g.id
+                for g in cls.browse([d.db_id for d in data])}
+            cls._sstp_code2id_cache.set(None, code2id)
+        return code2id
+
+    @classmethod
+    def create(cls, vlist):
+        groups = super().create(vlist)
+        cls._sstp_code2id_cache.clear()
+        return groups
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._sstp_code2id_cache.clear()
+
+    @classmethod
+    def delete(cls, groups):
+        super().delete(groups)
+        cls._sstp_code2id_cache.clear()
 
 
 class Tax(metaclass=PoolMeta):
     __name__ = 'account.tax'
+    _sstp_version_cache = Cache(__name__ + '.sstp_version', context=False)
     authority = fields.Many2One('census.place', "Authority",
             domain=[('parent', '=', None)],
             help="The entity that administers this tax")
@@ -16,3 +75,461 @@ class Tax(metaclass=PoolMeta):
             states={
                 'invisible': Bool(Eval('parent')),
                 })
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.authority, Index.Equality()),
+                    (t.name, Index.Equality()),
+                    (t.start_date, Index.Range()),
+                    where=t.authority != Null),
+                Index(
+                    t,
+                    (t.jurisdiction, Index.Equality()),
+                    (t.start_date, Index.Range()),
+                    where=t.jurisdiction != Null),
+                })
+        cls.__rpc__.update({
+                'sstp_rates': RPC(),
+                })
+
+    @classmethod
+    def create(cls, vlist):
+        taxes = super().create(vlist)
+        if any(t.authority for t in taxes):
+            cls._sstp_version_cache.clear()
+        return taxes
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        clear = False
+        for taxes, values in zip(actions, actions):
+            clear |= bool(values.get('authority')
+                or any(t.authority for t in taxes))
+        super().write(*args)
+        if clear:
+            cls._sstp_version_cache.clear()
+
+    @classmethod
+    def delete(cls, taxes):
+        clear = any(t.authority for t in taxes)
+        super().delete(taxes)
+        if clear:
+            cls._sstp_version_cache.clear()
+
+    @classmethod
+    def _after_sql_insert(cls, ids):
+        "Clear the SSTP versions after taxes are inserted with raw SQL"
+        cls._sstp_version_cache.clear()
+
+    @property
+    def sstp_rate_type(self):
+        "The SSTP rate type of the taxes grouping the dated versions"
+        if (self.authority and self.jurisdiction and not self.parent
+                and self.type == 'none'):
+            rate_type = self.name.rsplit(' ', 1)[-1]
+            if rate_type in RATE_TYPES:
+                return rate_type
+
+    @classmethod
+    def sstp_version(cls, jurisdiction, date, rate_type):
+        "Return the id of the version of the tax in effect at the date"
+        company = Transaction().context.get('company')
+        key = (company, jurisdiction, date, rate_type)
+        tax_id = cls._sstp_version_cache.get(key)
+        if tax_id is None:
+            taxes = cls.search([
+                    ('company', '=', company),
+                    ('jurisdiction', '=', jurisdiction),
+                    ('parent', '!=', None),
+                    ('name', 'like', '%% %s' % rate_type),
+                    ('start_date', '<=', date),
+                    ['OR',
+                        ('end_date', '=', None),
+                        ('end_date', '>=', date),
+                        ],
+                    ], order=[('start_date', 'DESC')], limit=1)
+            # -1 caches that no version is in effect
+            tax_id = taxes[0].id if taxes else -1
+            cls._sstp_version_cache.set(key, tax_id)
+        if tax_id >= 0:
+            return tax_id
+
+    def _sstp_childs(self, date):
+        """Return the children of the tax to compute at the date
+
+        For the SSTP taxes, only the version in effect is returned instead of
+        all the versions."""
+        rate_type = self.sstp_rate_type
+        if not rate_type:
+            return self.childs
+        with Transaction().set_context(company=self.company.id):
+            tax_id = self.sstp_version(self.jurisdiction.id, date, rate_type)
+        return [self.__class__(tax_id)] if tax_id is not None else []
+
+    @classmethod
+    def _unit_compute(cls, taxes, price_unit, date):
+        # Same as account but with the SSTP taxes kept as the grouping record
+        # of their version in effect, so its sequence and update unit price
+        # are used
+        res = []
+        for _, group_taxes in groupby(taxes, key=cls._group_taxes):
+            unit_price_variation = 0
+            for tax in group_taxes:
+                start_date = tax.start_date or dt.date.min
+                end_date = tax.end_date or dt.date.max
+                values = []
+                if not (start_date <= date <= end_date):
+                    continue
+                if tax.type != 'none':
+                    values.append(tax._process_tax(price_unit))
+                childs = tax._sstp_childs(date)
+                if childs:
+                    values.extend(cls._unit_compute(childs, price_unit, date))
+                if tax.update_unit_price:
+                    for value in values:
+                        unit_price_variation += value['amount']
+                res.extend(values)
+            price_unit += unit_price_variation
+        return res
+
+    @classmethod
+    def _reverse_rate_amount(cls, taxes, date):
+        # The SSTP taxes are grouped by _reverse_unit_compute before they are
+        # replaced by their version in effect
+        result = []
+        for tax in taxes:
+            if tax.sstp_rate_type:
+                result.extend(tax._sstp_childs(date))
+            else:
+                result.append(tax)
+        return super()._reverse_rate_amount(result, date)
+
+    @classmethod
+    def sstp_rates(cls, requests):
+        """Return the combined SSTP rate of each (place, date, rate type)
+
+        The combined rate is the sum of the rates in effect at the date for
+        the place and its county and state. It is None when no rate is in
+        effect at any of these levels."""
+        for _, _, rate_type in requests:
+            if rate_type not in RATE_TYPES:
+                raise ValueError("Unknown rate type %r" % rate_type)
+        if not requests:
+            return []
+
+        chains = cls._sstp_chains({p for p, _, _ in requests})
+        versions = cls._sstp_versions(
+            {j for c in chains.values() for j in c},
+            max_date=max(d for _, d, _ in requests))
+        return [
+            _combined_rate(versions, chains.get(place_id, []), date, rate_type)
+            for place_id, date, rate_type in requests]
+
+    @classmethod
+    def _sstp_chains(cls, place_ids):
+        "Return the ids of the place and its ancestors for each place"
+        pool = Pool()
+        Place = pool.get('census.place')
+        place = Place.__table__()
+        cursor = Transaction().connection.cursor()
+
+        chains = {}
+        for sub_ids in grouped_slice(place_ids):
+            cursor.execute(*place.select(place.id, place.path,
+                    where=reduce_ids(place.id, sub_ids)))
+            for place_id, path in cursor:
+                chains[place_id] = (
+                    [int(i) for i in path.split('/') if i] if path
+                    else [place_id])
+        return chains
+
+    @classmethod
+    def _sstp_versions(cls, jurisdictions, max_date=None):
+        """Return the start dates and the (start date, end date, rate) of the
+        jurisdictions sorted by start date for each (jurisdiction, rate type)
+        """
+        pool = Pool()
+        Version = pool.get('account.tax.sstp.version')
+        version = Version.__table__()
+        cursor = Transaction().connection.cursor()
+
+        versions = defaultdict(list)
+        for sub_ids in grouped_slice(jurisdictions):
+            where = reduce_ids(version.jurisdiction, sub_ids)
+            if max_date is not None:
+                where &= version.start_date <= max_date
+            cursor.execute(*version.select(
+                    version.jurisdiction, version.start_date,
+                    version.end_date,
+                    *[Column(version, t) for t in RATE_TYPES],
+                    where=where))
+            for jurisdiction, start_date, end_date, *rates in cursor:
+                for rate_type, rate in zip(RATE_TYPES, rates):
+                    versions[jurisdiction, rate_type].append(
+                        (start_date, end_date, rate))
+        for key, values in versions.items():
+            values.sort(key=lambda v: v[0])
+            versions[key] = ([v[0] for v in values], values)
+        return versions
+
+
+def _combined_rate(versions, chain, date, rate_type):
+    "Return the sum of the rates of the chain in effect at the date"
+    total = None
+    for jurisdiction in chain:
+        if (jurisdiction, rate_type) not in versions:
+            continue
+        starts, values = versions[jurisdiction, rate_type]
+        i = bisect_right(starts, date)
+        if not i:
+            continue
+        _, end_date, rate = values[i - 1]
+        if end_date is not None and end_date < date:
+            continue
+        total = (total or 0) + rate
+    return total
+
+
+class SSTPVersion(ModelSQL, ModelView):
+    "SSTP Rate Version"
+    __name__ = 'account.tax.sstp.version'
+    authority = fields.Many2One('census.place', "Authority", required=True,
+        ondelete='CASCADE', domain=[('parent', '=', None)])
+    code_fips = fields.Char("FIPS Code", required=True)
+    jurisdiction = fields.Many2One('census.place', "Jurisdiction")
+    group = fields.Many2One('account.tax.group', "Group")
+    start_date = fields.Date("Start Date", required=True)
+    end_date = fields.Date("End Date")
+    general_rate_intrastate = fields.Numeric("General Intrastate Rate",
+        digits=(14, 10), required=True)
+    general_rate_interstate = fields.Numeric("General Interstate Rate",
+        digits=(14, 10), required=True)
+    food_rate_intrastate = fields.Numeric("Food Intrastate Rate",
+        digits=(14, 10), required=True)
+    food_rate_interstate = fields.Numeric("Food Interstate Rate",
+        digits=(14, 10), required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('authority_code_fips_start_date_uniq',
+                Unique(t, t.authority, t.code_fips, t.start_date),
+                'account_us_sstp.msg_sstp_version_unique'),
+            ]
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.authority, Index.Equality()),
+                    (t.code_fips, Index.Equality()),
+                    (t.start_date, Index.Range())),
+                Index(
+                    t,
+                    (t.jurisdiction, Index.Equality()),
+                    (t.start_date, Index.Range()),
+                    (t.end_date, Index.Range()),
+                    where=t.jurisdiction != Null),
+                })
+        cls._order.insert(0, ('authority', 'ASC'))
+        cls._order.insert(1, ('code_fips', 'ASC'))
+        cls._order.insert(2, ('start_date', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        tax = Tax.__table__()
+        table_exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        # Migration from 7.2: fill the versions from the SSTP child taxes
+        if not table_exist:
+            cursor.execute(*tax.select(
+                    tax.name, tax.authority, tax.jurisdiction, tax.group,
+                    tax.start_date, tax.end_date, tax.rate,
+                    where=(tax.type == 'percentage')
+                    & (tax.parent != Null)
+                    & (tax.authority != Null)
+                    & (tax.start_date != Null),
+                    order_by=tax.id.asc))
+            versions = {}
+            for (name, authority, jurisdiction, group, start_date, end_date,
+                    rate) in cursor:
+                code_fips, _, rate_type = name.partition(' ')
+                if rate_type not in RATE_TYPES:
+                    continue
+                # The taxes of each company have the same rates
+                version = versions.setdefault(
+                    (authority, code_fips, start_date), {
+                        'authority': authority,
+                        'code_fips': code_fips,
+                        'jurisdiction': jurisdiction,
+                        'group': group,
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        })
+                version.setdefault(rate_type, rate)
+
+            names = ['authority', 'code_fips', 'jurisdiction', 'group',
+                'start_date', 'end_date'] + RATE_TYPES
+            columns = [table.create_uid, table.create_date] + [
+                Column(table, n) for n in names]
+            values = [
+                [transaction.user, CurrentTimestamp()] + [
+                    cls._fields[n].sql_format(v[n]) for n in names]
+                for v in versions.values()
+                if all(t in v for t in RATE_TYPES)]
+            for sub_values in grouped_slice(values):
+                cursor.execute(*table.insert(columns, list(sub_values)))
+
+
+class SSTPRate(ModelSQL, ModelView):
+    "SSTP Combined Rate"
+    __name__ = 'account.tax.sstp.rate'
+    place = fields.Many2One('census.place', "Place", required=True,
+        readonly=True, ondelete='CASCADE')
+    rate_type = fields.Selection([
+            ('general_rate_intrastate', "General Intrastate"),
+            ('general_rate_interstate', "General Interstate"),
+            ('food_rate_intrastate', "Food Intrastate"),
+            ('food_rate_interstate', "Food Interstate"),
+            ], "Rate Type", required=True, readonly=True)
+    start_date = fields.Date("Start Date", required=True, readonly=True)
+    end_date = fields.Date("End Date", readonly=True)
+    rate = fields.Numeric("Rate", digits=(14, 10), required=True,
+        readonly=True,
+        help="The sum of the rates of the place, its county and its state.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(
+                    t,
+                    (t.place, Index.Equality()),
+                    (t.rate_type, Index.Equality()),
+                    (t.start_date, Index.Range())),
+                })
+        cls._order.insert(0, ('place', 'ASC'))
+        cls._order.insert(1, ('rate_type', 'ASC'))
+        cls._order.insert(2, ('start_date', 'ASC'))
+        cls.__rpc__.update({
+                'refresh': RPC(readonly=False),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Place = pool.get('census.place')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        table_exist = backend.TableHandler.table_exist(cls._table)
+
+        super().__register__(module_name)
+
+        table_h = cls.__table_handler__(module_name)
+        # Migration from 7.2: the rates are shared by the companies
+        company_exist = table_h.column_exist('company')
+        if company_exist:
+            table_h.drop_column('company')
+        # Build the rates of the existing versions
+        if not table_exist or company_exist:
+            cursor.execute(*table.delete())
+            cls.refresh([p.id for p in Place.search([('parent', '=', None)])])
+
+    @classmethod
+    def get_rate(cls, place, date, rate_type):
+        "Return the combined rate of the place in effect at the date"
+        rates = cls.search([
+                ('place', '=', place),
+                ('rate_type', '=', rate_type),
+                ('start_date', '<=', date),
+                ['OR',
+                    ('end_date', '=', None),
+                    ('end_date', '>=', date),
+                    ],
+                ], order=[('start_date', 'DESC')], limit=1)
+        if rates:
+            rate, = rates
+            return rate.rate
+
+    @classmethod
+    def refresh(cls, jurisdictions):
+        """Rebuild the combined rates of the jurisdictions and of the places
+        they contain"""
+        pool = Pool()
+        ModelAccess = pool.get('ir.model.access')
+        Place = pool.get('census.place')
+        Tax = pool.get('account.tax')
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # The rates are replaced with raw SQL
+        ModelAccess.check(cls.__name__, 'write')
+        places = Place.search([('parent', 'child_of', list(jurisdictions))])
+        place_ids = [p.id for p in places]
+        chains = Tax._sstp_chains(place_ids)
+        versions = Tax._sstp_versions({j for c in chains.values() for j in c})
+
+        for sub_ids in grouped_slice(place_ids):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.place, sub_ids)))
+
+        names = ['place', 'rate_type', 'start_date', 'end_date', 'rate']
+        columns = [table.create_uid, table.create_date] + [
+            Column(table, n) for n in names]
+        values = [
+            [transaction.user, CurrentTimestamp()] + [
+                cls._fields[n].sql_format(v) for n, v in zip(names, [
+                        place_id, rate_type, start_date, end_date, rate])]
+            for place_id in place_ids
+            for rate_type in RATE_TYPES
+            for start_date, end_date, rate in _combined_intervals(
+                versions, chains.get(place_id, []), rate_type)]
+        for sub_values in grouped_slice(values):
+            cursor.execute(*table.insert(columns, list(sub_values)))
+
+
+def _combined_intervals(versions, chain, rate_type):
+    """Yield the (start date, end date, rate) intervals of the combined rate
+    of the chain"""
+    boundaries = set()
+    for jurisdiction in chain:
+        if (jurisdiction, rate_type) not in versions:
+            continue
+        for start_date, end_date, _ in versions[jurisdiction, rate_type][1]:
+            boundaries.add(start_date)
+            if end_date is not None and end_date < dt.date.max:
+                boundaries.add(end_date + dt.timedelta(days=1))
+    boundaries = sorted(boundaries)
+
+    current = None
+    for start_date, next_date in zip(
+            boundaries, boundaries[1:] + [None]):
+        rate = _combined_rate(versions, chain, start_date, rate_type)
+        if current and current[2] == rate:
+            current[1] = next_date
+            continue
+        if current and current[2] is not None:
+            yield _interval(*current)
+        current = [start_date, next_date, rate]
+    if current and current[2] is not None:
+        yield _interval(*current)
+
+
+def _interval(start_date, next_date, rate):
+    end_date = next_date - dt.timedelta(days=1) if next_date else None
+    return start_date, end_date, rate
@@ -1,11 +1,839 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from trytond.tests.test_tryton import ModuleTestCase
+import datetime as dt
+import hashlib
+import json
+import os
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import count
+from unittest.mock import Mock, patch
+from urllib.error import HTTPError
+
+from proteus import config as proteus_config
+
+from trytond.modules.account_us_sstp.benchmarks.server import serve
+from trytond.modules.account_us_sstp.scripts import (
+    cache, export_gazetteer, import_rates, snapshot)
+from trytond.modules.account_us_sstp.scripts.gazetteer import (
+    Gazetteer, Place as GazetteerPlace, write as write_gazetteer)
+from trytond.modules.account_us_sstp.scripts.import_rates import (
+    Checkpoint, Row as RateRow, _active, _chunked_by_jurisdiction, _skip_to,
+    _threaded)
+from trytond.modules.account_us_sstp.scripts.loader import TrytondLoader
+from trytond.modules.account_us_sstp.scripts.metrics import Metrics
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    DB_NAME, ModuleTestCase, with_transaction)
+from trytond.transaction import Transaction
 
 
 class AccountUsSstpTestCase(ModuleTestCase):
     "Test Account Us Sstp module"
     module = 'account_us_sstp'
 
+    @with_transaction()
+    def test_class_code_code2id(self):
+        "Test class code code2id cache"
+        pool = Pool()
+        ClassCode = pool.get('census.class_code')
+
+        class_code, = ClassCode.search([('code', '=', 'C1')])
+        self.assertEqual(ClassCode.code2id()['C1'], class_code.id)
+        self.assertEqual(ClassCode.get_by_code('C1'), class_code)
+
+        new, = ClassCode.create([{'code': 'XX', 'description': "Test"}])
+        self.assertEqual(ClassCode.code2id()['XX'], new.id)
+
+        ClassCode.write([new], {'code': 'XY'})
+        self.assertNotIn('XX', ClassCode.code2id())
+        self.assertEqual(ClassCode.code2id()['XY'], new.id)
+
+        ClassCode.delete([new])
+        self.assertNotIn('XY', ClassCode.code2id())
+        self.assertIsNone(ClassCode.get_by_code('XY'))
+
+    @with_transaction()
+    def test_region_code2id(self):
+        "Test region code2id cache"
+        pool = Pool()
+        Region = pool.get('census.region')
+
+        region, = Region.search([('code', '=', 'R3')])
+        self.assertEqual(Region.code2id()['R3'], region.id)
+        self.assertNotIn(None, Region.code2id())
+
+    @with_transaction()
+    def test_place_path(self):
+        "Test place path and child_of"
+        pool = Pool()
+        Place = pool.get('census.place')
+
+        state, county, other, place = create_places([
+                ("Utah", '49', None),
+                ("Salt Lake", '035', '49'),
+                ("Utah", '049', '49'),
+                ("Salt Lake City", '67000', '035'),
+                ])
+
+        self.assertEqual(
+            place.path, '%s/%s/%s/' % (state.id, county.id, place.id))
+        self.assertEqual(
+            [p.level for p in [state, county, place]],
+            ['state', 'county', 'place'])
+        self.assertEqual(
+            Place.search([('level', '=', 'county')]), [county, other])
+        self.assertEqual(
+            Place.search([('parent', 'child_of', [county.id])]),
+            [county, place])
+        self.assertEqual(
+            Place.search([('parent', 'parent_of', [place.id])],
+                order=[('id', 'ASC')]),
+            [state, county, place])
+
+        place.parent = other
+        place.save()
+        self.assertEqual(
+            place.path, '%s/%s/%s/' % (state.id, other.id, place.id))
+        self.assertEqual(
+            Place.search([('parent', 'child_of', [county.id])]), [county])
+
+    @with_transaction()
+    def test_place_search_rec_name(self):
+        "Test place search_rec_name and autocomplete"
+        pool = Pool()
+        Place = pool.get('census.place')
+
+        county, city, springs = create_places([
+                ("Salt Lake", '035', None),
+                ("Salt Lake City", '67000', None),
+                ("Saltair Springs", '03500', None),
+                ])
+
+        self.assertEqual(
+            Place.search([('rec_name', 'ilike', '%035%')]), [county, springs])
+        self.assertEqual(
+            Place.search([('rec_name', 'ilike', '%lake%')]), [county, city])
+        self.assertEqual(
+            Place.search([('rec_name', 'not ilike', '%lake%')]), [springs])
+        self.assertEqual(
+            [r['id'] for r in Place.autocomplete('035')],
+            [county.id, springs.id])
+        self.assertEqual(
+            [r['id'] for r in Place.autocomplete('salt', limit=2)],
+            [county.id, city.id])
+
+    @with_transaction()
+    def test_place_boundary(self):
+        "Test place lookup by boundary"
+        pool = Pool()
+        Boundary = pool.get('census.place.boundary')
+
+        county, city = create_places([
+                ("Salt Lake", '035', None),
+                ("Salt Lake City", '67000', None),
+                ])
+        values = {'subdivision': county.subdivision.id}
+        Boundary.create([
+                dict(values, type='zip', low=841000000, high=841199999,
+                    place=county.id),
+                dict(values, type='zip4', low=841010001, high=841010099,
+                    place=city.id),
+                dict(values, type='address', low=1, high=99, parity='odd',
+                    street='S MAIN ST', zip='84111', place=city.id),
+                dict(values, type='address', low=1, high=99, parity='both',
+                    street='N STATE ST', zip='84111', place=county.id,
+                    end_date=dt.date(2000, 1, 1)),
+                ])
+
+        self.assertEqual(
+            Boundary.places_by_zip(
+                ['84101', '84101-0050', '841010100', '84200', 'foo']),
+            [county.id, city.id, county.id, None, None])
+        self.assertEqual(
+            Boundary.places_by_address([
+                    ('51', 's  main st', '84111'),
+                    ('52', 'S MAIN ST', '84111'),
+                    ('51', 'N STATE ST', '84111'),
+                    (None, None, '84200'),
+                    ]),
+            [city.id, county.id, county.id, None])
+
+        Boundary.create([dict(values, type='zip', low=842000000,
+                    high=842009999, place=city.id)])
+        self.assertEqual(Boundary.places_by_zip(['84200']), [city.id])
+
+        Boundary.create([dict(values, type='zip4', low=841020000,
+                    high=841029999, place=city.id,
+                    end_date=dt.date(2000, 1, 1))])
+        self.assertEqual(
+            Boundary.places_by_zip(['84102-0050'], date=dt.date(1999, 1, 1)),
+            [city.id])
+        self.assertEqual(Boundary.places_by_zip(['84102-0050']), [county.id])
+
+    def test_gazetteer(self):
+        "Test gazetteer lookups"
+        places = [
+            GazetteerPlace(3, 'US-UT', '67000', 1454997, "Salt Lake City",
+                2, 'C1'),
+            GazetteerPlace(1, 'US-UT', '49', 1455989, "Utah", None, None),
+            GazetteerPlace(2, 'US-UT', '035', 1448032, "Salt Lake", 1, 'H1'),
+            GazetteerPlace(4, 'US-ID', '035', None, "Clearwater", None, 'H1'),
+            ]
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'gazetteer')
+            self.assertEqual(write_gazetteer(filename, places), 4)
+
+            with Gazetteer(filename) as gazetteer:
+                self.assertEqual(len(gazetteer), 4)
+                self.assertEqual(
+                    list(gazetteer), sorted(places, key=lambda p: p.id))
+                self.assertEqual(gazetteer.get(3), places[0])
+                self.assertIsNone(gazetteer.get(5))
+                self.assertEqual(gazetteer.by_fips('49'), [places[1]])
+                self.assertEqual(
+                    gazetteer.by_fips('035', 'US-ID'), [places[3]])
+                self.assertEqual(len(gazetteer.by_fips('0', prefix=True)), 2)
+                self.assertEqual(gazetteer.by_gnis(1448032), places[2])
+                self.assertIsNone(gazetteer.by_gnis(1))
+                self.assertEqual(gazetteer.by_name('utah'), [places[1]])
+                self.assertEqual(
+                    gazetteer.by_name('salt', prefix=True),
+                    [places[2], places[0]])
+                self.assertEqual(
+                    gazetteer.by_name('salt', prefix=True, limit=1),
+                    [places[2]])
+
+    @with_transaction()
+    def test_export_gazetteer_language(self):
+        "Test exporting the gazetteer names in a language"
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        Place = pool.get('census.place')
+
+        lang, = Lang.search([('code', '=', 'fr')])
+        Lang.write([lang], {'translatable': True})
+        state, = create_places([("Utah", '49', None)])
+        with Transaction().set_context(language='fr'):
+            Place.write([state], {'name': "Utah (fr)"})
+
+        proteus = proteus_config.Config()
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(proteus_config, 'set_trytond'), \
+                patch.object(proteus_config, 'get_config',
+                    return_value=proteus), \
+                patch.object(export_gazetteer, 'get_loader',
+                    return_value=_TransactionLoader()):
+            filename = os.path.join(directory, 'gazetteer')
+            for language, name in [(None, "Utah"), ('fr', "Utah (fr)")]:
+                export_gazetteer.main(
+                    DB_NAME, filename, language=language)
+                with Gazetteer(filename) as gazetteer:
+                    self.assertEqual(gazetteer.get(state.id).name, name)
+        self.assertEqual(proteus.context, {})
+
+    def test_cache_fetcher(self):
+        "Test fetching the files through the cache"
+        url = 'https://www.example.com/rates/UTR.csv'
+        with tempfile.TemporaryDirectory() as directory:
+            www = os.path.join(directory, 'www')
+            cache_dir = os.path.join(directory, 'cache')
+            path = os.path.join(www, 'www.example.com', 'rates', 'UTR.csv')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'rates')
+            stat = os.stat(path)
+
+            def objects():
+                return sorted(
+                    os.listdir(os.path.join(cache_dir, 'objects')))
+
+            with serve(www) as mirror:
+                fetcher = cache.Fetcher(cache=cache_dir, mirror=mirror)
+                with fetcher.urlopen(url) as response:
+                    self.assertEqual(response.read(), b'rates')
+                    self.assertEqual(
+                        response.url, mirror + 'www.example.com/rates/UTR.csv')
+                self.assertEqual(
+                    objects(), [hashlib.sha256(b'rates').hexdigest()])
+
+                # The same content is stored once
+                other = os.path.join(os.path.dirname(path), 'IDR.csv')
+                with open(other, 'wb') as f:
+                    f.write(b'rates')
+                with fetcher.urlopen(
+                        'https://www.example.com/rates/IDR.csv') as response:
+                    self.assertEqual(response.read(), b'rates')
+                self.assertEqual(len(objects()), 1)
+
+                # Not modified since the cached file
+                with open(path, 'wb') as f:
+                    f.write(b'new rates')
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                with fetcher.urlopen(url) as response:
+                    self.assertEqual(response.read(), b'rates')
+
+                os.utime(path, (stat.st_atime + 10, stat.st_mtime + 10))
+                with fetcher.urlopen(url) as response:
+                    self.assertEqual(response.read(), b'new rates')
+                self.assertEqual(len(objects()), 2)
+
+            # The cached file is used when the server is unreachable
+            with fetcher.urlopen(url) as response:
+                self.assertEqual(response.read(), b'new rates')
+
+            meta_path = os.path.join(cache_dir, 'urls',
+                hashlib.sha256(
+                    (mirror + 'www.example.com/rates/UTR.csv').encode('utf-8')
+                    ).hexdigest() + '.json')
+            with open(meta_path) as f:
+                meta = json.load(f)
+            self.assertTrue(meta['last_modified'])
+            meta['etag'] = '"1"'
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+            requests = []
+
+            def not_modified(request):
+                requests.append(request)
+                raise HTTPError(
+                    request.full_url, 304, "Not Modified", None, None)
+            with patch.object(cache, 'urlopen', not_modified), \
+                    fetcher.urlopen(url) as response:
+                self.assertEqual(response.read(), b'new rates')
+            request, = requests
+            self.assertEqual(request.get_header('If-none-match'), '"1"')
+            self.assertEqual(
+                request.get_header('If-modified-since'),
+                meta['last_modified'])
+
+    def test_cache_fetcher_source(self):
+        "Test fetching the files from an offline source"
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['UTR.zip', 'UTB.zip', 'IDR.csv', 'README']:
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(name.encode('utf-8'))
+            fetcher = cache.Fetcher(source=directory)
+
+            self.assertEqual(
+                fetcher.listdir(), ['IDR.csv', 'README', 'UTB.zip', 'UTR.zip'])
+            with fetcher.urlopen(
+                    'https://www.example.com/rates/UTR.zip') as response:
+                self.assertEqual(response.read(), b'UTR.zip')
+            with self.assertRaises(HTTPError):
+                fetcher.urlopen('https://www.example.com/rates/MTR.zip')
+
+            with patch.object(import_rates, 'fetcher', fetcher), \
+                    patch.dict(import_rates._files, clear=True):
+                files = dict(import_rates._get_files())
+            self.assertEqual(files, {
+                    'ID': import_rates.BASE_URL + 'IDR.csv',
+                    'UT': import_rates.BASE_URL + 'UTR.zip',
+                    })
+
+    def test_import_rates_active(self):
+        "Test active rate versions of import_rates"
+        rows = [
+            _rate_row('49', '20200101', '20201231'),
+            _rate_row('49', '20210101', '29991231'),
+            _rate_row('035', '20190101', '20210630'),
+            _rate_row('035', '20210701', '29991231'),
+            _rate_row('67000', '20210101', '20210531'),
+            ]
+        stats = {'skipped': 0}
+
+        self.assertEqual(
+            list(_active(rows, dt.date(2021, 6, 1), stats)),
+            [rows[1], rows[2], rows[3]])
+        self.assertEqual(stats['skipped'], 2)
+
+    def test_import_rates_skip_to(self):
+        "Test resuming the rate rows after a jurisdiction"
+        rows = [_rate_row(c, '20210101', '29991231')
+            for c in ['49', '035', '035', '045', '67000']]
+
+        self.assertEqual(list(_skip_to(rows, '035')), rows[3:])
+        self.assertEqual(list(_skip_to(rows, '67000')), [])
+        with self.assertRaises(ValueError):
+            list(_skip_to(rows, '099'))
+
+    def test_import_rates_chunked_by_jurisdiction(self):
+        "Test chunks of rate rows by jurisdiction"
+        rows = [_rate_row(c, '20210101', '29991231')
+            for c in ['49', '035', '035', '035', '045', '67000']]
+
+        self.assertEqual(
+            list(_chunked_by_jurisdiction(rows, 2)),
+            [rows[:4], rows[4:]])
+        self.assertEqual(
+            list(_chunked_by_jurisdiction(rows, 1)),
+            [rows[:1], rows[1:4], rows[4:5], rows[5:]])
+        self.assertEqual(list(_chunked_by_jurisdiction([], 2)), [])
+
+    def test_import_rates_threaded(self):
+        "Test items produced by a thread"
+        self.assertEqual(list(_threaded(iter(range(10)), 2)), list(range(10)))
+
+        def fail():
+            yield 1
+            raise ValueError("fail")
+        items = _threaded(fail(), 2)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+        produced = []
+
+        def produce():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        items = _threaded(produce(), 2)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertLess(len(produced), 100)
+
+    def test_import_rates_checkpoint(self):
+        "Test checkpoint of import_rates"
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'checkpoint')
+            checkpoint = Checkpoint(filename)
+            checkpoint.set('UT', '035')
+            other = Checkpoint(filename)
+            other.set('ID', '001')
+            checkpoint.set('UT', '045')
+
+            self.assertEqual(Checkpoint(filename).get('UT'), '045')
+            self.assertEqual(Checkpoint(filename).get('ID'), '001')
+
+            checkpoint.done('UT')
+            self.assertIsNone(Checkpoint(filename).get('UT'))
+            self.assertEqual(Checkpoint(filename).get('ID'), '001')
+
+        checkpoint = Checkpoint()
+        checkpoint.set('UT', '035')
+        self.assertEqual(checkpoint.get('UT'), '035')
+
+    def test_metrics_phase(self):
+        "Test the values accumulated by the metrics phases"
+        if not tracemalloc.is_tracing():
+            self.addCleanup(tracemalloc.stop)
+        metrics = Metrics()
+        metrics.loader = loader = _CountingLoader()
+        metrics.install(proteus_config.Config(), trace_memory=True)
+        self.assertTrue(metrics.tracing)
+
+        with metrics.phase('save', 'UT') as save:
+            loader.calls += 1
+            with metrics.phase('build', 'UT') as build:
+                data = bytearray(10 ** 6)
+                build['rows'] += 1
+            del data
+            with metrics.phase('refresh', 'UT') as refresh:
+                loader.calls += 2
+        with metrics.phase('save', 'UT') as other:
+            loader.calls += 1
+        self.assertEqual(list(metrics.iterate('parse', 'UT', 'abc')),
+            ['a', 'b', 'c'])
+
+        self.assertIs(other, save)
+        self.assertEqual(
+            [save['loader_calls'], build['loader_calls'],
+                refresh['loader_calls']], [4, 0, 2])
+        self.assertEqual(build['rows'], 1)
+        self.assertEqual(metrics.get('parse', 'UT')['rows'], 3)
+        self.assertGreaterEqual(build['peak_mem'], 10 ** 6)
+        self.assertGreaterEqual(save['peak_mem'], build['peak_mem'])
+        self.assertLess(refresh['peak_mem'], 10 ** 6)
+        self.assertGreaterEqual(
+            save['wall_s'], build['wall_s'] + refresh['wall_s'])
+
+    def test_metrics_dump(self):
+        "Test the JSON written by the metrics"
+        metrics = Metrics()
+        with metrics.phase('save', 'UT') as phase:
+            phase['rows'] += 2
+        metrics.merge([
+                dict(phase='save', state='UT', wall_s=1.0, rows=3,
+                    rpc_calls=1, loader_calls=2, peak_mem=10),
+                dict(phase='save', state='ID', wall_s=2.0, rows=4,
+                    rpc_calls=0, loader_calls=1, peak_mem=20),
+                ])
+        metrics.merge([
+                dict(phase='save', state='UT', wall_s=1.0, rows=1,
+                    rpc_calls=0, loader_calls=1, peak_mem=5),
+                ])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'metrics.json')
+            metrics.dump(filename, script='import_rates', codes=['UT', 'ID'])
+            with open(filename) as f:
+                result = json.load(f)
+
+        self.assertEqual(result['script'], 'import_rates')
+        self.assertEqual(result['codes'], ['UT', 'ID'])
+        for key in ['started', 'wall_s', 'peak_rss_kib',
+                'children_peak_rss_kib']:
+            self.assertIn(key, result)
+        phases = {(p['state'], p['phase']): p for p in result['phases']}
+        self.assertEqual(set(phases), {('UT', 'save'), ('ID', 'save')})
+        ut = phases[('UT', 'save')]
+        self.assertEqual(
+            [ut['rows'], ut['rpc_calls'], ut['loader_calls'], ut['peak_mem']],
+            [6, 1, 3, 10])
+        self.assertGreaterEqual(ut['wall_s'], 2.0)
+        self.assertEqual(ut['rows_per_s'], ut['rows'] / ut['wall_s'])
+        self.assertEqual(phases[('ID', 'save')]['rows_per_s'], 2.0)
+
+    def test_snapshot_restore(self):
+        "Test the remapping of the ids restored from a snapshot"
+        loader = _SnapshotLoader()
+        rows = [
+            {'id': 10, 'parent': None, 'name': "A"},
+            {'id': 11, 'parent': 10, 'name': "A1"},
+            {'id': 12, 'parent': None, 'name': "B"},
+            {'id': 13, 'parent': 12, 'name': "B1"},
+            {'id': 14, 'parent': 11, 'name': "A11"},
+            ]
+
+        def get_values(row, parent):
+            return {'name': row['name'], 'parent': parent}
+
+        with patch.object(snapshot, 'loader', loader):
+            ids = snapshot._restore('account.tax', rows, {'B': 99},
+                lambda v: v['name'], get_values, 10)
+
+        self.assertEqual(ids, {10: 1, 11: 2, 12: 99, 13: 3, 14: 4})
+        self.assertEqual(loader.created, [
+                [{'name': "A", 'parent': None}],
+                [{'name': "A1", 'parent': 1}, {'name': "B1", 'parent': 99}],
+                [{'name': "A11", 'parent': 2}],
+                ])
+
+    def test_snapshot_restore_versions_taxes(self):
+        "Test restoring the SSTP versions and taxes of a snapshot"
+        loader = _SnapshotLoader()
+        places = {1: 101, 2: 102}
+        Model = Mock()
+        Model.get.return_value.sstp_code2id.return_value = {'00': 5}
+        company = Mock(sstp_rate_types=['general_rate_intrastate'])
+        versions = [
+            [1, 2, '035', '00', '2021-01-01', None,
+                '0.01', '0.02', '0.03', '0.04'],
+            [1, 3, '045', '00', '2021-01-01', '2021-12-31',
+                '0.01', '0.02', '0.03', '0.04'],
+            ]
+        taxes = [
+            [10, None, 1, 2, '035 general_rate_intrastate', "Salt Lake tax",
+                'none', '00', None, None, None],
+            [11, None, 1, 2, '035 food_rate_intrastate', "Salt Lake tax",
+                'none', '00', None, None, None],
+            [12, 10, 1, 2, '035 general_rate_intrastate', "Salt Lake tax",
+                'percentage', '00', '0.01', '2021-01-01', None],
+            [13, 11, 1, 2, '035 food_rate_intrastate', "Salt Lake tax",
+                'percentage', '00', '0.03', '2021-01-01', None],
+            ]
+
+        with patch.object(snapshot, 'loader', loader), \
+                patch.object(snapshot, 'Model', Model), \
+                patch.object(proteus_config, 'get_config',
+                    return_value=proteus_config.Config()), \
+                patch.object(snapshot, 'get_company', return_value=company), \
+                patch.object(snapshot, 'get_tax_account',
+                    return_value=[Mock(id=7)]):
+            self.assertEqual(
+                snapshot.restore_versions(versions, places, 10), {101})
+            self.assertEqual(
+                snapshot.restore_taxes(taxes, places, 10), {101})
+
+        (version, other), (parent,), (child,) = loader.created
+        self.assertEqual(version, {
+                'authority': 101,
+                'jurisdiction': 102,
+                'code_fips': '035',
+                'group': 5,
+                'start_date': dt.date(2021, 1, 1),
+                'end_date': None,
+                'general_rate_intrastate': Decimal('0.01'),
+                'general_rate_interstate': Decimal('0.02'),
+                'food_rate_intrastate': Decimal('0.03'),
+                'food_rate_interstate': Decimal('0.04'),
+                })
+        self.assertIsNone(other['jurisdiction'])
+        self.assertEqual(other['end_date'], dt.date(2021, 12, 31))
+        self.assertEqual(parent['name'], '035 general_rate_intrastate')
+        self.assertEqual(
+            [parent['authority'], parent['jurisdiction'], parent['group'],
+                parent['parent']], [101, 102, 5, None])
+        self.assertEqual(
+            [child['parent'], child['rate'], child['start_date'],
+                child['invoice_account'], child['credit_note_account']],
+            [3, Decimal('0.01'), dt.date(2021, 1, 1), 7, 7])
+
+    def test_snapshot_versions_from_taxes(self):
+        "Test the SSTP versions of the taxes of a first format snapshot"
+        rates = dict(zip(
+                snapshot.RATE_TYPES, ['0.01', '0.02', '0.03', '0.04']))
+        rows = [[1, None, 1, 2, '035 general_rate_intrastate', "Tax",
+                'none', '00', None, None, None]]
+        for i, (rate_type, rate) in enumerate(rates.items()):
+            rows.append([10 + i, 1, 1, 2, '035 %s' % rate_type, "Tax",
+                    'percentage', '00', rate, '2021-01-01', None])
+            # The version of 045 misses the food interstate rate
+            if rate_type != 'food_rate_interstate':
+                rows.append([20 + i, 1, 1, None, '045 %s' % rate_type, "Tax",
+                        'percentage', '00', rate, '2020-01-01',
+                        '2020-12-31'])
+        rows.append([30, None, 1, 2, '035 other', "Tax",
+                'percentage', '00', '0.05', '2021-01-01', None])
+
+        self.assertEqual(snapshot._versions_from_taxes(rows), [
+                [1, 2, '035', '00', '2021-01-01', None,
+                    '0.01', '0.02', '0.03', '0.04'],
+                ])
+
+    @with_transaction()
+    def test_tax_group_sstp_code2id(self):
+        "Test SSTP tax group code2id cache"
+        pool = Pool()
+        TaxGroup = pool.get('account.tax.group')
+
+        group, = TaxGroup.search([('code', '=', '45')])
+        self.assertEqual(TaxGroup.sstp_code2id()['45'], group.id)
+
+        other, = TaxGroup.create([{'code': '45', 'name': "Other"}])
+        self.assertEqual(TaxGroup.sstp_code2id()['45'], group.id)
+        self.assertNotIn(other.id, TaxGroup.sstp_code2id().values())
+
+    @with_transaction()
+    def test_tax_sstp_rates(self):
+        "Test SSTP combined rates"
+        pool = Pool()
+        Rate = pool.get('account.tax.sstp.rate')
+        Version = pool.get('account.tax.sstp.version')
+        Tax = pool.get('account.tax')
+        TaxGroup = pool.get('account.tax.group')
+
+        company = create_company()
+        with set_company(company):
+            state, county, place = create_places([
+                    ("Utah", '49', None),
+                    ("Salt Lake", '035', '49'),
+                    ("Salt Lake City", '67000', '035'),
+                    ])
+
+            group = TaxGroup.sstp_code2id()['00']
+            rate_type = 'general_rate_intrastate'
+            Version.create([{
+                        'authority': state.id,
+                        'code_fips': jurisdiction.code_fips,
+                        'jurisdiction': jurisdiction.id,
+                        'group': group,
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        'general_rate_intrastate': Decimal(rate),
+                        'general_rate_interstate': Decimal(rate),
+                        'food_rate_intrastate': Decimal(0),
+                        'food_rate_interstate': Decimal(0),
+                        } for jurisdiction, start_date, end_date, rate in [
+                        (state, dt.date(2020, 1, 1), None, '0.0485'),
+                        (county, dt.date(2020, 1, 1), dt.date(2020, 12, 31),
+                            '0.01'),
+                        (county, dt.date(2021, 1, 1), None, '0.015'),
+                        ]])
+
+            self.assertEqual(Tax.sstp_rates([
+                        (place.id, dt.date(2020, 6, 1), rate_type),
+                        (place.id, dt.date(2021, 6, 1), rate_type),
+                        (county.id, dt.date(2020, 6, 1), rate_type),
+                        (state.id, dt.date(2021, 6, 1), rate_type),
+                        (place.id, dt.date(2019, 6, 1), rate_type),
+                        (place.id, dt.date(2020, 6, 1),
+                            'food_rate_intrastate'),
+                        ]), [
+                    Decimal('0.0585'), Decimal('0.0635'), Decimal('0.0585'),
+                    Decimal('0.0485'), None, Decimal(0)])
+            with self.assertRaises(ValueError):
+                Tax.sstp_rates([(place.id, dt.date(2020, 6, 1), 'foo')])
+
+            Rate.refresh([county.id])
+            self.assertEqual(
+                [(r.place, r.start_date, r.end_date, r.rate)
+                    for r in Rate.search([('rate_type', '=', rate_type)])],
+                [(county, dt.date(2020, 1, 1), dt.date(2020, 12, 31),
+                        Decimal('0.0585')),
+                    (county, dt.date(2021, 1, 1), None, Decimal('0.0635')),
+                    (place, dt.date(2020, 1, 1), dt.date(2020, 12, 31),
+                        Decimal('0.0585')),
+                    (place, dt.date(2021, 1, 1), None, Decimal('0.0635')),
+                    ])
+            self.assertEqual(
+                Rate.get_rate(place.id, dt.date(2021, 6, 1), rate_type),
+                Decimal('0.0635'))
+            self.assertIsNone(
+                Rate.get_rate(state.id, dt.date(2021, 6, 1), rate_type))
+
+            Rate.refresh([state.id])
+            self.assertEqual(
+                Rate.get_rate(state.id, dt.date(2021, 6, 1), rate_type),
+                Decimal('0.0485'))
+            self.assertEqual(
+                Rate.search([('rate_type', '=', rate_type)], count=True), 5)
+            self.assertEqual(
+                Rate.get_rate(place.id, dt.date(2021, 6, 1),
+                    'food_rate_interstate'),
+                Decimal(0))
+
+    @with_transaction()
+    def test_tax_sstp_version(self):
+        "Test SSTP tax version resolution"
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        TaxGroup = pool.get('account.tax.group')
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+
+        company = create_company()
+        with set_company(company):
+            account_type, = AccountType.create([{
+                        'name': "Tax", 'statement': 'balance',
+                        }])
+            account, = Account.create([{
+                        'name': "Tax", 'type': account_type.id,
+                        }])
+            state, = create_places([("Utah", '49', None)])
+            group = TaxGroup.sstp_code2id()['00']
+            values = {
+                'name': '49 general_rate_intrastate',
+                'description': "Utah",
+                'group': group,
+                'authority': state.id,
+                'jurisdiction': state.id,
+                }
+            parent, = Tax.create([dict(values, type='none')])
+            versions = Tax.create([dict(values,
+                        type='percentage',
+                        rate=Decimal(rate),
+                        parent=parent.id,
+                        start_date=start_date,
+                        end_date=end_date,
+                        invoice_account=account.id,
+                        credit_note_account=account.id)
+                    for start_date, end_date, rate in [
+                        (dt.date(2020, 1, 1), dt.date(2020, 12, 31), '0.01'),
+                        (dt.date(2021, 1, 1), None, '0.015'),
+                        ]])
+            rate_type = parent.sstp_rate_type
+            jurisdiction = state.id
+
+            self.assertEqual(rate_type, 'general_rate_intrastate')
+            self.assertEqual(
+                Tax.sstp_version(jurisdiction, dt.date(2020, 6, 1), rate_type),
+                versions[0].id)
+            self.assertIsNone(
+                Tax.sstp_version(jurisdiction, dt.date(2019, 6, 1), rate_type))
+            self.assertEqual(
+                [t['amount'] for t in Tax.compute(
+                        [parent], Decimal(100), 1, dt.date(2021, 6, 1))],
+                [Decimal('1.5')])
+
+            Tax.write([versions[1]], {'rate': Decimal('0.02')})
+            self.assertEqual(
+                [t['amount'] for t in Tax.compute(
+                        [parent], Decimal(100), 1, dt.date(2021, 6, 1))],
+                [Decimal('2')])
+
+            # The parent is the grouping record of its version
+            Tax.write([parent], {'sequence': 1, 'update_unit_price': True})
+            other, = Tax.create([{
+                        'name': "Other",
+                        'description': "Other",
+                        'type': 'percentage',
+                        'rate': Decimal('0.1'),
+                        'sequence': 2,
+                        'invoice_account': account.id,
+                        'credit_note_account': account.id,
+                        }])
+            self.assertEqual(
+                [(t['tax'], t['base'], t['amount']) for t in Tax.compute(
+                        [other, parent], Decimal(100), 1,
+                        dt.date(2021, 6, 1))],
+                [(versions[1], Decimal(100), Decimal('2')),
+                    (other, Decimal(102), Decimal('10.2'))])
+            self.assertEqual(
+                Tax.reverse_compute(
+                    Decimal('112.2'), [other, parent], dt.date(2021, 6, 1)),
+                Decimal(100))
+
+            Tax.delete([versions[1]])
+            self.assertEqual(
+                Tax.compute([parent], Decimal(100), 1, dt.date(2021, 6, 1)),
+                [])
+
+
+def create_places(places):
+    """Create the places of Utah from (name, FIPS code, parent FIPS code)
+
+    The parents must be before their children. The places are returned in
+    the same order."""
+    pool = Pool()
+    Country = pool.get('country.country')
+    Subdivision = pool.get('country.subdivision')
+    Place = pool.get('census.place')
+
+    country = Country(name="United States", code='US')
+    country.save()
+    subdivision = Subdivision(
+        name="Utah", code='US-UT', type='state', country=country)
+    subdivision.save()
+    records = {}
+    for name, code_fips, parent in places:
+        records[code_fips], = Place.create([{
+                    'name': name,
+                    'code_fips': code_fips,
+                    'country': country.id,
+                    'subdivision': subdivision.id,
+                    'parent': records[parent].id if parent else None,
+                    }])
+    return [records[c] for _, c, _ in places]
+
+
+class _TransactionLoader(TrytondLoader):
+    "Load in the transaction of the test with the proteus context"
+
+    @contextmanager
+    def transaction(self, readonly=False):
+        with Transaction().set_context(proteus_config.get_config().context):
+            yield Pool()
+
+
+class _CountingLoader(object):
+
+    def __init__(self):
+        self.calls = 0
+
+
+class _SnapshotLoader(object):
+    "Record the values created with consecutive ids"
+
+    def __init__(self):
+        self.created = []
+        self.ids = count(1)
+
+    def search_read(self, model, domain, fields_names):
+        return []
+
+    def create(self, model, vlist):
+        self.created.append(list(vlist))
+        return [next(self.ids) for _ in vlist]
+
+
+def _rate_row(code_fips, start_date, end_date):
+    return RateRow('UT', '00', code_fips, '0.01', '0.01', '0', '0',
+        start_date, end_date)
+
 
 del ModuleTestCase